@@ -0,0 +1,219 @@
+"""Scaling benchmarks for mlp.ag against ASE.
+
+This times the neighbor lists and the Lennard-Jones energy, forces and stress
+while sweeping the number of atoms, the cutoff radius and the skew of the
+cell, and times ase.neighborlist.NeighborList and
+ase.calculators.lj.LennardJones on the same structures. For each case the best
+wall time of several repeats and the peak memory (from tracemalloc) of one
+more run are stored as JSON, so runs can be compared across commits.
+
+Run the benchmarks from the repository root. The mlp package has to be
+importable, so either install it with `pip install -e .` or put the root on
+the path:
+
+    PYTHONPATH=. python benchmarks/bench_ag.py run -o results.json
+
+Compare two runs, and exit with status 1 if anything got slower than the
+threshold ratio:
+
+    PYTHONPATH=. python benchmarks/bench_ag.py compare old.json new.json \\
+        --threshold 1.2
+
+"""
+import argparse
+import datetime
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import autograd
+import ase
+from ase.build import bulk
+from ase.calculators.lj import LennardJones
+from ase.neighborlist import NeighborList
+
+from mlp.ag import neighborlist as nl
+from mlp.ag import lennardjones as lj
+
+
+def structure(repeat, skew=0.0):
+    """The fcc Cu supercell used in the tests, sheared by skew."""
+    atoms = bulk('Cu', 'fcc', a=3.6).repeat(repeat)
+    atoms.rattle(0.02, seed=42)
+    strain = np.zeros((3, 3))
+    strain[0, 1] = skew
+    atoms.set_cell(np.dot(atoms.cell, (np.eye(3) + strain).T),
+                   scale_atoms=True)
+    return atoms
+
+
+def ase_neighborlist(atoms, cutoff_radius):
+    n = NeighborList([cutoff_radius / 2] * len(atoms), skin=0.01,
+                     self_interaction=False, bothways=True)
+    n.update(atoms)
+
+
+def ase_lj(atoms, cutoff_radius, prop):
+    atoms = atoms.copy()
+    atoms.set_calculator(LennardJones(sigma=cutoff_radius / 3))
+    return getattr(atoms, prop)()
+
+
+def cases(atoms, cutoff_radius):
+    """The functions to time, as (name, function) pairs."""
+    p, cell = atoms.positions, np.array(atoms.cell)
+    params = {'sigma': cutoff_radius / 3}
+    return [
+        ('get_distances',
+         lambda: nl.get_distances(p, cell, cutoff_radius)),
+        ('get_neighbors_oneway',
+         lambda: nl.get_neighbors_oneway(p, cell, cutoff_radius)),
+        ('get_neighbors_binned',
+         lambda: nl.get_neighbors_binned(p, cell, cutoff_radius)),
+        ('ase.NeighborList',
+         lambda: ase_neighborlist(atoms, cutoff_radius)),
+        ('energy', lambda: lj.energy(params, p, cell)),
+        ('forces', lambda: lj.forces(params, p, cell)),
+        ('stress', lambda: lj.stress(params, p, cell)),
+        ('energy_forces_stress',
+         lambda: lj.energy_forces_stress(params, p, cell)),
+        ('ase.LennardJones.energy',
+         lambda: ase_lj(atoms, cutoff_radius, 'get_potential_energy')),
+        ('ase.LennardJones.forces',
+         lambda: ase_lj(atoms, cutoff_radius, 'get_forces')),
+        ('ase.LennardJones.stress',
+         lambda: ase_lj(atoms, cutoff_radius, 'get_stress')),
+    ]
+
+
+def measure(f, repeats):
+    """Return the best wall time of f and the peak memory of one call."""
+    times = []
+    for i in range(repeats):
+        t0 = time.perf_counter()
+        f()
+        times += [time.perf_counter() - t0]
+
+    tracemalloc.start()
+    f()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(times), peak
+
+
+def sweeps(args):
+    """The (sweep, repeat, cutoff_radius, skew) combinations to run."""
+    for n in args.repeats:
+        yield 'natoms', (n, n, n), args.cutoff, 0.0
+    for cutoff_radius in args.cutoffs:
+        yield 'cutoff', (2, 2, 2), cutoff_radius, 0.0
+    for skew in args.skews:
+        yield 'skew', (2, 2, 2), args.cutoff, skew
+
+
+def run(args):
+    results = []
+    for sweep, repeat, cutoff_radius, skew in sweeps(args):
+        atoms = structure(repeat, skew)
+        for name, f in cases(atoms, cutoff_radius):
+            if args.only and not any(s in name for s in args.only):
+                continue
+            wall_time, peak_memory = measure(f, args.number)
+            results += [{'sweep': sweep,
+                         'name': name,
+                         'natoms': len(atoms),
+                         'cutoff_radius': cutoff_radius,
+                         'skew': skew,
+                         'time': wall_time,
+                         'peak_memory': peak_memory}]
+            print('{sweep:7s} {name:25s} natoms={natoms:5d} '
+                  'cutoff={cutoff_radius:5.2f} skew={skew:4.2f} '
+                  '{time:10.4f} s {peak_memory:12d} B'.format(**results[-1]))
+            sys.stdout.flush()
+
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                         stderr=subprocess.DEVNULL)
+        commit = commit.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    data = {'metadata': {'date': datetime.datetime.now().isoformat(),
+                         'commit': commit,
+                         'python': platform.python_version(),
+                         'numpy': np.__version__,
+                         'autograd': getattr(autograd, '__version__', None),
+                         'ase': ase.__version__,
+                         'machine': platform.machine()},
+            'results': results}
+
+    with open(args.output, 'w') as f:
+        f.write(json.dumps(data, indent=2))
+
+
+def key(result):
+    return (result['sweep'], result['name'], result['natoms'],
+            result['cutoff_radius'], result['skew'])
+
+
+def compare(args):
+    with open(args.old) as f:
+        old = {key(r): r for r in json.loads(f.read())['results']}
+    with open(args.new) as f:
+        new = {key(r): r for r in json.loads(f.read())['results']}
+
+    regressions = 0
+    for k in sorted(set(old) & set(new)):
+        ratio = new[k]['time'] / old[k]['time']
+        memory_ratio = (new[k]['peak_memory'] /
+                        max(old[k]['peak_memory'], 1))
+        flag = ''
+        if ratio > args.threshold or memory_ratio > args.threshold:
+            flag = '  <-- regression'
+            regressions += 1
+        print('{0:7s} {1:25s} natoms={2:5d} cutoff={3:5.2f} skew={4:4.2f} '
+              'time x{5:6.2f} memory x{6:6.2f}{7}'.format(
+                  *k, ratio, memory_ratio, flag))
+    return 1 if regressions else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest='command')
+
+    p = subparsers.add_parser('run', help='run the benchmarks')
+    p.add_argument('-o', '--output', default='benchmark.json')
+    p.add_argument('--repeats', type=int, nargs='+', default=[1, 2, 3, 4],
+                   help='supercell repeats for the natoms sweep')
+    p.add_argument('--cutoff', type=float, default=5.0,
+                   help='cutoff radius for the natoms and skew sweeps')
+    p.add_argument('--cutoffs', type=float, nargs='+',
+                   default=[3.0, 5.0, 7.0, 9.0])
+    p.add_argument('--skews', type=float, nargs='+',
+                   default=[0.0, 0.25, 0.5, 1.0])
+    p.add_argument('-n', '--number', type=int, default=3,
+                   help='timing repeats, the best one is kept')
+    p.add_argument('--only', nargs='+',
+                   help='only run cases whose name contains one of these')
+
+    p = subparsers.add_parser('compare', help='compare two runs')
+    p.add_argument('old')
+    p.add_argument('new')
+    p.add_argument('--threshold', type=float, default=1.2)
+
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        run(args)
+    elif args.command == 'compare':
+        return compare(args)
+    else:
+        parser.print_help()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
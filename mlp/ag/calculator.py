@@ -0,0 +1,79 @@
+"""An ASE calculator for the autograd Lennard-Jones potential."""
+
+import numpy as np
+from ase.calculators.calculator import (Calculator, all_changes,
+                                        PropertyNotImplementedError)
+from mlp.ag.lennardjones import energy_forces_stress
+from mlp.ag.neighborlist import NeighborList
+
+
+class LennardJones(Calculator):
+    """ASE calculator built on `mlp.ag.lennardjones`.
+
+    The energy, forces and stress are always computed together with
+    `energy_forces_stress`, and cached until the atoms or the parameters
+    change. Asking for all three properties costs a single evaluation. A
+    Verlet `NeighborList` is kept between calls, so small moves in an optimizer
+    or MD run reuse the pairs.
+
+    The periodic boundary conditions of the atoms are used, so slabs and
+    clusters need no vacuum padding. Like the ASE Lennard-Jones calculator,
+    the stress is only available when the cell has three lattice vectors.
+
+    Parameters
+    ----------
+
+    sigma, epsilon : the Lennard-Jones parameters. Default 1.0.
+
+    skin : skin distance of the Verlet neighbor list. Default 0.3.
+
+    backend : 'autograd' or 'analytic', see `mlp.ag.lennardjones.forces`.
+
+    """
+    implemented_properties = ['energy', 'free_energy', 'forces', 'stress']
+    default_parameters = {'sigma': 1.0,
+                          'epsilon': 1.0,
+                          'skin': 0.3,
+                          'backend': 'autograd'}
+    nolabel = True
+
+    def __init__(self, **kwargs):
+        self.neighborlist = None
+        Calculator.__init__(self, **kwargs)
+
+    def set(self, **kwargs):
+        changed_parameters = Calculator.set(self, **kwargs)
+        if changed_parameters:
+            self.reset()
+            # The cutoff radius depends on sigma.
+            self.neighborlist = None
+        return changed_parameters
+
+    def calculate(self, atoms=None, properties=['energy'],
+                  system_changes=all_changes):
+        Calculator.calculate(self, atoms, properties, system_changes)
+
+        if ('stress' in properties and
+                self.atoms.number_of_lattice_vectors != 3):
+            raise PropertyNotImplementedError
+
+        params = {'sigma': self.parameters.sigma,
+                  'epsilon': self.parameters.epsilon}
+
+        if self.neighborlist is None:
+            self.neighborlist = NeighborList(3 * self.parameters.sigma,
+                                             skin=self.parameters.skin)
+
+        energy, forces, stress = energy_forces_stress(
+            params,
+            self.atoms.get_positions(),
+            np.array(self.atoms.get_cell()),
+            neighborlist=self.neighborlist,
+            backend=self.parameters.backend,
+            pbc=self.atoms.pbc)
+
+        self.results['energy'] = float(energy)
+        self.results['free_energy'] = float(energy)
+        self.results['forces'] = np.array(forces)
+        if self.atoms.number_of_lattice_vectors == 3:
+            self.results['stress'] = np.array(stress)
@@ -0,0 +1,156 @@
+"""Mini-batch fitting of Lennard-Jones parameters to energies and forces.
+
+`train` streams shuffled mini-batches of structures through an Adam optimizer.
+The loss is a weighted sum of the mean squared energy error and the mean
+squared force error, with the forces from `mlp.ag.lennardjones.forces`.
+Parameters are saved in the same JSON format as docs/argon-lj.json.
+
+"""
+import json
+import autograd.numpy as np
+from autograd import value_and_grad
+from autograd.misc import flatten
+from mlp.ag.lennardjones import energy_batch, forces as lj_forces
+
+
+def save_params(params, fname):
+    """Write params to fname as JSON.
+
+    autograd returns the params as 0d arrays, which are not serializable, so
+    they are cast to floats.
+    """
+    with open(fname, 'w') as f:
+        f.write(json.dumps({key: float(value)
+                            for key, value in params.items()}))
+
+
+def load_params(fname):
+    """Read params written by `save_params`."""
+    with open(fname) as f:
+        return json.loads(f.read())
+
+
+def loss(params, positions, cells, energies, forces=None,
+         energy_weight=1.0, force_weight=1.0):
+    """The weighted energy and force loss of a set of structures.
+
+    Parameters
+    ----------
+
+    params : dictionary of paramters.
+
+    positions : a list of arrays with shape (natoms_b, 3)
+
+    cells: a list of unit cells. Shape = (3, 3) each
+
+    energies: the reference energies. Shape = (nstructures,)
+
+    forces: a list of reference forces with shape (natoms_b, 3), optional.
+
+    energy_weight, force_weight: weights of the two mean squared errors.
+
+    Returns
+    -------
+    loss : float
+    """
+    errs = energy_batch(params, positions, cells) - np.asarray(energies)
+    result = energy_weight * np.mean(errs**2)
+
+    if forces is not None and force_weight != 0:
+        ferrs = [lj_forces(params, p, c) - f
+                 for p, c, f in zip(positions, cells, forces)]
+        nforces = sum(np.size(f) for f in forces)
+        result = result + force_weight * sum(np.sum(e**2)
+                                             for e in ferrs) / nforces
+    return result
+
+
+def train(params, positions, cells, energies, forces=None,
+          energy_weight=1.0, force_weight=1.0, batch_size=16,
+          step_size=0.01, b1=0.9, b2=0.999, eps=1e-8,
+          epochs=100, loss_goal=None, checkpoint=None, seed=None,
+          callback=None):
+    """Fit params with Adam on shuffled mini-batches of structures.
+
+    Parameters
+    ----------
+
+    params : dictionary of initial paramters, e.g.
+      {'epsilon': 0.1, 'sigma': 3.5}
+
+    positions, cells, energies, forces : the training data, see `loss`. A
+      `mlp.data.Dataset` provides all of them as attributes.
+
+    energy_weight, force_weight: weights of the energy and force errors.
+
+    batch_size: number of structures in a mini-batch.
+
+    step_size, b1, b2, eps: the Adam parameters, as in
+      autograd.misc.optimizers.adam.
+
+    epochs: maximum number of passes over the data.
+
+    loss_goal: stop after the first epoch whose mean mini-batch loss is at or
+      below this value.
+
+    checkpoint: a filename the params are saved to after every epoch.
+
+    seed: seed for the shuffling.
+
+    callback: called as callback(params, epoch, epoch_loss) after each epoch.
+
+    Returns
+    -------
+    params, history : the fitted params and a list of the mean mini-batch loss
+    of each epoch.
+
+    """
+    nstructures = len(energies)
+    energies = np.asarray(energies, dtype=float)
+    rng = np.random.RandomState(seed)
+
+    flat_params, unflatten = flatten({key: np.array(value, dtype=float)
+                                      for key, value in params.items()})
+
+    def batch_loss(flat_params, batch):
+        return loss(unflatten(flat_params),
+                    [positions[k] for k in batch],
+                    [cells[k] for k in batch],
+                    energies[batch],
+                    None if forces is None else [forces[k] for k in batch],
+                    energy_weight, force_weight)
+
+    f = value_and_grad(batch_loss)
+
+    m = np.zeros(len(flat_params))
+    v = np.zeros(len(flat_params))
+    step = 0
+    history = []
+    for epoch in range(epochs):
+        order = rng.permutation(nstructures)
+        epoch_loss = 0.0
+        for start in range(0, nstructures, batch_size):
+            batch = order[start:start + batch_size]
+            value, g = f(flat_params, batch)
+            epoch_loss += value * len(batch)
+
+            m = (1 - b1) * g + b1 * m
+            v = (1 - b2) * (g**2) + b2 * v
+            mhat = m / (1 - b1**(step + 1))
+            vhat = v / (1 - b2**(step + 1))
+            flat_params = flat_params - step_size * mhat / (np.sqrt(vhat) +
+                                                            eps)
+            step += 1
+
+        epoch_loss /= nstructures
+        history += [epoch_loss]
+        params = unflatten(flat_params)
+
+        if checkpoint is not None:
+            save_params(params, checkpoint)
+        if callback is not None:
+            callback(params, epoch, epoch_loss)
+        if loss_goal is not None and epoch_loss <= loss_goal:
+            break
+
+    return unflatten(flat_params), history
@@ -0,0 +1,100 @@
+"""Opt-in instrumentation of the neighbor search and energy evaluation.
+
+Use `record` to collect counters and timings from everything called in its
+block:
+
+    from mlp.ag import instrument
+
+    with instrument.record() as report:
+        forces(params, positions, cell)
+    print(report)
+
+The hot paths in `mlp.ag.neighborlist` and `mlp.ag.lennardjones` report
+
+  image_cells: number of periodic images searched.
+  candidate_pairs: number of pair distances computed.
+  pairs_in_cutoff: number of those inside the cutoff radius.
+  bytes: bytes of the large arrays that were allocated.
+
+and the wall time spent in each phase (offsets, distances, masking, pair
+terms and gradient). Time in the gradient phase includes the forward pass it
+traces. The phases are marked with `tic` and `toc`. When no report is
+recording, each hook is one check of a module global.
+
+"""
+import time
+from contextlib import contextmanager
+from autograd.tracer import getval
+
+_report = None
+
+
+class Report:
+    """Counters and phase timings collected by `record`."""
+
+    def __init__(self):
+        self.counters = {}
+        self.times = {}
+        self.calls = {}
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + int(value)
+
+    def add_bytes(self, *arrays):
+        self.count('bytes', sum(getval(a).nbytes for a in arrays))
+
+    def add_time(self, phase, seconds):
+        self.times[phase] = self.times.get(phase, 0.0) + seconds
+        self.calls[phase] = self.calls.get(phase, 0) + 1
+
+    def as_dict(self):
+        return {'counters': dict(self.counters),
+                'times': dict(self.times),
+                'calls': dict(self.calls)}
+
+    def __str__(self):
+        lines = ['{0:20s} {1:>14s}'.format('counter', 'value')]
+        for name, value in sorted(self.counters.items()):
+            lines += ['{0:20s} {1:14d}'.format(name, value)]
+        lines += ['', '{0:20s} {1:>14s} {2:>8s}'.format('phase', 'time (s)',
+                                                        'calls')]
+        for phase, seconds in sorted(self.times.items()):
+            lines += ['{0:20s} {1:14.6f} {2:8d}'.format(phase, seconds,
+                                                        self.calls[phase])]
+        return '\n'.join(lines)
+
+
+def active():
+    """Return the Report that is recording, or None."""
+    return _report
+
+
+@contextmanager
+def record():
+    """Record counters and timings in a new Report while in the block."""
+    global _report
+    previous = _report
+    _report = Report()
+    try:
+        yield _report
+    finally:
+        _report = previous
+
+
+def tic():
+    """Start timing a phase. Returns None when nothing is recording."""
+    if _report is None:
+        return None
+    return time.perf_counter()
+
+
+def toc(phase, t0):
+    """Add the time since t0 to phase, and return the time to start the next.
+
+    This does nothing and returns None when t0 is None.
+    """
+    if t0 is None or _report is None:
+        return None
+    t = time.perf_counter()
+    _report.add_time(phase, t - t0)
+    return t
@@ -0,0 +1,231 @@
+"""Incremental Lennard-Jones energies for single atom Monte Carlo moves.
+
+`IncrementalEnergy` keeps the atoms sorted into linked-cell bins and the
+energy of each atom. A trial move, insertion or deletion of atom k only looks
+at the bins around k, so it costs O(neighbors) instead of a full `energy`
+call. The trial is then accepted or rejected:
+
+    mc = IncrementalEnergy(params, positions, cell)
+    dE = mc.trial_move(k, positions[k] + step)
+    if np.random.rand() < np.exp(-dE / kT):
+        mc.accept()
+    else:
+        mc.reject()
+
+The energy is the same as `mlp.ag.lennardjones.energy`: the cutoff radius is
+3 * sigma and each pair energy is shifted to zero at the cutoff. This module
+is plain numpy, and is not meant to be differentiated.
+
+"""
+import itertools
+import numpy as np
+
+
+class IncrementalEnergy:
+    """A Lennard-Jones energy that is updated one atom at a time.
+
+    Parameters
+    ----------
+
+    params : dictionary of paramters.
+      Defaults to {'sigma': 1.0, 'epsilon': 1.0}
+
+    positions : array of floats. Shape = (natoms, 3)
+
+    cell: array of unit cell vectors. Shape = (3, 3). The cell is periodic in
+      all directions and does not change.
+
+    Attributes
+    ----------
+
+    energy : the energy of the accepted configuration.
+
+    atom_energies : the energy of each atom. Half of each pair energy is
+      assigned to each atom of the pair, so they sum to the energy.
+
+    positions : the accepted positions, wrapped into the unit cell.
+
+    Only one trial is pending at a time. Starting a new trial discards the
+    pending one, as if it was rejected.
+
+    """
+
+    def __init__(self, params, positions, cell):
+        self.sigma = params.get('sigma', 1.0)
+        self.epsilon = params.get('epsilon', 1.0)
+        self.cutoff_radius = 3 * self.sigma
+        rc = self.cutoff_radius
+        self.e0 = 4 * self.epsilon * ((self.sigma / rc)**12 -
+                                      (self.sigma / rc)**6)
+
+        self.cell = np.array(cell, dtype=float)
+        self.inverse_cell = np.linalg.inv(self.cell)
+
+        # perpendicular widths of the cell
+        h = 1 / np.linalg.norm(self.inverse_cell, axis=0)
+        self.nbins = np.maximum(1, (h / rc).astype(int))
+        # number of bins to search on each side of the home bin
+        nsearch = np.ceil(rc * self.nbins / h).astype(int)
+        self.stencil = np.array(list(itertools.product(
+            *[np.arange(-n, n + 1) for n in nsearch])))
+
+        # An atom interacts with its own periodic images. That energy does
+        # not depend on the position, so it only changes with the number of
+        # atoms.
+        m = np.ceil(rc / h).astype(int)
+        offsets = np.array(list(itertools.product(
+            *[np.arange(-n, n + 1) for n in m])))
+        r2 = (np.dot(offsets, self.cell)**2).sum(1)
+        inside = (r2 <= rc**2) & (r2 > 0.0)
+        self.self_energy = np.sum(self._phi(r2[inside])) / 2
+
+        self.positions = self._wrap(np.asarray(positions, dtype=float))
+        self.bins = self._bin(self.positions)[0]
+        self.members = [[] for _ in range(np.prod(self.nbins))]
+        for k, flat in enumerate(self.bins):
+            self.members[flat].append(k)
+
+        self.atom_energies = np.full(len(self.positions), self.self_energy)
+        for k in range(len(self.positions)):
+            j, e = self._pair_energies(self.positions[k], k)
+            self.atom_energies[k] += np.sum(e) / 2
+        self.energy = np.sum(self.atom_energies)
+
+        self.pending = None
+
+    def __len__(self):
+        return len(self.positions)
+
+    def _phi(self, r2):
+        """The shifted pair energy at squared distances inside the cutoff."""
+        c6 = (self.sigma**2 / r2)**3
+        return 4 * self.epsilon * (c6**2 - c6) - self.e0
+
+    def _wrap(self, x):
+        fractional_coords = np.dot(x, self.inverse_cell)
+        return x - np.dot(np.floor(fractional_coords), self.cell)
+
+    def _bin(self, x):
+        """The flat bin index and the bin of wrapped positions."""
+        fractional_coords = np.dot(x, self.inverse_cell)
+        b = np.minimum((fractional_coords * self.nbins).astype(int),
+                       self.nbins - 1)
+        return self._flat(b), b
+
+    def _flat(self, b):
+        nbins = self.nbins
+        return (b[..., 0] * nbins[1] + b[..., 1]) * nbins[2] + b[..., 2]
+
+    def _append(self, x):
+        flat, _ = self._bin(x)
+        self.members[flat].append(len(self.positions))
+        self.positions = np.concatenate([self.positions, [x]])
+        self.bins = np.concatenate([self.bins, [flat]])
+
+    def _pair_energies(self, x, exclude=None):
+        """Pair energies of a wrapped position x with the atoms around it.
+
+        The atom exclude, usually the one at x, is skipped in every image.
+
+        Returns
+        -------
+        j, energies : the neighbor of each pair and its energy. An atom can
+        appear more than once, once for each image inside the cutoff radius.
+        """
+        _, b = self._bin(x)
+        neighbors = b + self.stencil
+        wrapped = neighbors % self.nbins
+        offsets = (neighbors - wrapped) // self.nbins
+
+        j, n = [], []
+        for flat, offset in zip(self._flat(wrapped), offsets):
+            members = self.members[flat]
+            if members:
+                j += members
+                n += [offset] * len(members)
+        if not j:
+            return np.zeros(0, dtype=int), np.zeros(0)
+
+        j, n = np.array(j), np.array(n)
+        if exclude is not None:
+            keep = j != exclude
+            j, n = j[keep], n[keep]
+
+        d = self.positions[j] + np.dot(n, self.cell) - x
+        r2 = (d**2).sum(1)
+        inside = (r2 <= self.cutoff_radius**2) & (r2 > 0.0)
+        return j[inside], self._phi(r2[inside])
+
+    def trial_move(self, k, position):
+        """Return the energy change of moving atom k to position."""
+        x = self._wrap(np.asarray(position, dtype=float))
+        j_old, e_old = self._pair_energies(self.positions[k], k)
+        j_new, e_new = self._pair_energies(x, k)
+        dE = np.sum(e_new) - np.sum(e_old)
+        self.pending = ('move', k, x,
+                        np.concatenate([j_old, j_new]),
+                        np.concatenate([-e_old, e_new]), dE)
+        return dE
+
+    def trial_insert(self, position):
+        """Return the energy change of adding an atom at position.
+
+        If it is accepted the new atom has the index len(self).
+        """
+        x = self._wrap(np.asarray(position, dtype=float))
+        j, e = self._pair_energies(x)
+        dE = np.sum(e) + self.self_energy
+        self.pending = ('insert', len(self), x, j, e, dE)
+        return dE
+
+    def trial_delete(self, k):
+        """Return the energy change of removing atom k.
+
+        If it is accepted the last atom takes the index k.
+        """
+        j, e = self._pair_energies(self.positions[k], k)
+        dE = -np.sum(e) - self.self_energy
+        self.pending = ('delete', k, None, j, -e, dE)
+        return dE
+
+    def reject(self):
+        """Discard the pending trial."""
+        self.pending = None
+
+    def accept(self):
+        """Apply the pending trial. Returns its energy change."""
+        if self.pending is None:
+            raise RuntimeError('There is no trial to accept.')
+        kind, k, x, j, de, dE = self.pending
+        self.pending = None
+
+        # The neighbors get half of each pair energy change, and atom k the
+        # other half.
+        np.add.at(self.atom_energies, j, de / 2)
+
+        if kind == 'move':
+            self.atom_energies[k] += dE / 2
+            self.members[self.bins[k]].remove(k)
+            flat, _ = self._bin(x)
+            self.members[flat].append(k)
+            self.positions[k] = x
+            self.bins[k] = flat
+        elif kind == 'insert':
+            self._append(x)
+            self.atom_energies = np.concatenate(
+                [self.atom_energies, [dE - np.sum(de) / 2]])
+        else:
+            last = len(self) - 1
+            self.members[self.bins[k]].remove(k)
+            if k != last:
+                members = self.members[self.bins[last]]
+                members[members.index(last)] = k
+                self.positions[k] = self.positions[last]
+                self.bins[k] = self.bins[last]
+                self.atom_energies[k] = self.atom_energies[last]
+            self.positions = self.positions[:last]
+            self.bins = self.bins[:last]
+            self.atom_energies = self.atom_energies[:last]
+
+        self.energy += dE
+        return dE
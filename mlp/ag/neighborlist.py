@@ -1,9 +1,13 @@
 """A neighborlist."""
+import itertools
 import autograd.numpy as np
+from autograd.tracer import getval
+from mlp.ag import instrument
 
 
 def get_distances(positions, cell, cutoff_radius, skin=0.01,
-                  strain=np.zeros((3, 3))):
+                  strain=np.zeros((3, 3)), dtype=np.float64, atoms=None,
+                  pbc=(True, True, True)):
     """Get distances to atoms in a periodic unitcell.
 
     Parameters
@@ -14,6 +18,14 @@ def get_distances(positions, cell, cutoff_radius, skin=0.01,
     cutoff_radius: Maximum radius to get neighbor distances for. float
     skin: A tolerance for the cutoff_radius. float
     strain: array-like (3, 3)
+    dtype: float type of the pair vectors and distances. np.float32 halves the
+    memory of the large arrays, see the notes below.
+    atoms: a slice or index array of the atoms i to get distances from.
+    Defaults to all atoms. The cell offsets do not depend on it, so blocks of
+    atoms can be evaluated one at a time, see `block_size`.
+    pbc: periodic boundary conditions along each cell vector, like
+    `Atoms.pbc`. There are no images along the non-periodic ones, and their
+    cell vectors may be zero.
 
     Returns
     -------
@@ -21,66 +33,427 @@ def get_distances(positions, cell, cutoff_radius, skin=0.01,
     distances : an array of dimension (atom_i, atom_j, distance) The shape is
     (natoms, natoms, nunitcells) where nunitcells is the total number of unit
     cells required to tile the space to be sure all neighbors will be found. The
-    atoms that are outside the cutoff radius are zeroed.
+    atoms that are outside the cutoff radius are zeroed. With atoms, the first
+    dimension only has the selected atoms.
+
+    The atoms are wrapped into the unit cell first. Cells that cannot hold a
+    neighbor of any atom are skipped, which matters in skewed cells. When the
+    cutoff radius plus skin is less than half of every perpendicular width of
+    the cell, only the minimum image of each pair is used and nunitcells is
+    1.
+
+    Notes
+    -----
+
+    The strain, cell offsets and position differences are computed in float64
+    and then rounded to dtype, so in float32 the absolute error of a distance
+    is about 1e-7 times the size of the cell plus the cutoff radius, i.e. a
+    few 1e-6 Angstrom. A pair within that of the cutoff radius may be kept or
+    dropped differently than in float64.
 
     """
+    t = instrument.tic()
+
+    cell, pbc = _complete_cell(cell, pbc)
     strain_tensor = np.eye(3) + strain
     cell = np.dot(strain_tensor, cell.T).T
     positions = np.dot(strain_tensor, positions.T).T
 
+    # Wrap the atoms into the unit cell along the periodic axes. This is a
+    # constant shift, so it does not change the gradients.
+    inverse_cell = np.linalg.inv(getval(cell))
+    wraps = np.floor(np.dot(getval(positions), inverse_cell)) * pbc
+    positions = positions - np.dot(wraps, cell)
+
+    if atoms is None:
+        atoms = slice(None)
+
+    # The vectors between the atoms in the home cell, (atom_i, atom_j, 3)
+    dp = positions[None, :] - positions[atoms][:, None]
+
+    offsets = _offsets(getval(positions), getval(cell),
+                       cutoff_radius + skin, pbc)
+
+    if offsets is None:
+        # The minimum image is the only one that can be inside the cutoff
+        # radius, and rounding the fractional coordinates finds it.
+        shifts = np.round(np.dot(getval(dp), inverse_cell)) * pbc
+        pv = (dp - np.dot(shifts, cell)).astype(dtype)[:, :, None]
+        noffsets = 1
+        t = instrument.toc('offsets', t)
+    else:
+        # Now we have a vector of unit cell offsets (offset_index, 3)
+        # We convert that to cartesian coordinate offsets
+        cart_offsets = np.dot(offsets, cell).astype(dtype)
+        noffsets = len(offsets)
+        t = instrument.toc('offsets', t)
+
+        # we need to offset each vector by each offset.
+        # (atom_i, atom_j, offset, 3)
+        pv = dp.astype(dtype)[:, :, None] + cart_offsets[None, None]
+
+    # This is the distance squared
+    # (atom_i, atom_j, distance_ij)
+    d2 = np.sum(pv**2, axis=3)
+    t = instrument.toc('distances', t)
+
+    # The gradient of sqrt is nan at r=0, so we do this round about way to
+    # avoid that. The masks are multiplied in, since the gradient of np.where
+    # is always float64.
+    zeros = getval(d2) == 0.0
+    d = np.sqrt(d2 + zeros)
+    result = d * (~zeros & (getval(d) <= cutoff_radius + skin))
+    instrument.toc('masking', t)
+
+    report = instrument.active()
+    if report is not None:
+        report.count('image_cells', noffsets)
+        report.count('candidate_pairs', np.size(getval(d2)))
+        report.count('pairs_in_cutoff', np.sum(getval(result) > 0))
+        report.add_bytes(pv, d2, d, result)
+
+    return result
+
+
+def _offsets(positions, cell, cutoff_radius, pbc=(True, True, True)):
+    """The integer cell offsets `get_distances` searches. Shape = (n, 3)
+
+    The positions must be wrapped into the unit cell along the periodic axes.
+    Returns None when the cutoff radius is less than half of every
+    perpendicular width of the cell along a periodic axis, where the minimum
+    image convention applies. The offsets are zero along non-periodic axes.
+    """
     inverse_cell = np.linalg.inv(cell)
     num_repeats = cutoff_radius * np.linalg.norm(inverse_cell, axis=0)
+    num_repeats = num_repeats * pbc
 
-    fractional_coords = np.dot(positions, inverse_cell) % 1
-    mins = np.min(np.floor(fractional_coords - num_repeats), axis=0)
-    maxs = np.max(np.ceil(fractional_coords + num_repeats), axis=0)
+    # num_repeats is the cutoff radius over the perpendicular widths.
+    if np.max(num_repeats) < 0.5:
+        return None
 
-    # Now we generate a set of cell offsets
-    v0_range = np.arange(mins[0], maxs[0])
-    v1_range = np.arange(mins[1], maxs[1])
-    v2_range = np.arange(mins[2], maxs[2])
+    # The vectors between atoms in the home cell have fractional coordinates
+    # within +-spread, so offset n can only hold a neighbor if
+    # |n + u| <= num_repeats along each axis for some |u| <= spread.
+    fractional_coords = np.dot(positions, inverse_cell)
+    spread = (np.max(fractional_coords, axis=0) -
+              np.min(fractional_coords, axis=0))
+    nmax = np.floor(num_repeats + spread) * pbc
+    offsets = np.array(list(itertools.product(
+        *[np.arange(-n, n + 1) for n in nmax])))
 
-    xhat = np.array([1, 0, 0])
-    yhat = np.array([0, 1, 0])
-    zhat = np.array([0, 0, 1])
+    # In skewed cells many of those boxes are still too far away, so the
+    # offsets are pruned by the distance of the box of n + u to the origin.
+    d = _box_distances(offsets - spread, offsets + spread, cell)
+    return offsets[d <= cutoff_radius * (1 + 1e-8)]
 
-    v0_range = v0_range[:, None] * xhat[None, :]
-    v1_range = v1_range[:, None] * yhat[None, :]
-    v2_range = v2_range[:, None] * zhat[None, :]
 
-    offsets = (v0_range[:, None, None] +
-               v1_range[None, :, None] +
-               v2_range[None, None, :])
-    offsets = offsets.reshape(-1, 3)
+def _box_distances(lower, upper, cell):
+    """The distances from the origin to boxes in fractional coordinates.
 
-    # Now we have a vector of unit cell offsets (offset_index, 3)
-    # We convert that to cartesian coordinate offsets
-    cart_offsets = np.dot(offsets, cell)
+    Each box is the set of points m.dot(cell) with lower <= m <= upper, a
+    parallelepiped. The closest point solves a small quadratic program. Its
+    KKT points have each coordinate either free or at one of its bounds, so
+    all 27 of those patterns are solved and the closest feasible point of any
+    pattern is the answer.
 
-    # we need to offset each coord by each offset.
-    # This array is (atom_index, offset, 3)
-    shifted_cart_coords = positions[:, None] + cart_offsets[None, :]
+    Parameters
+    ----------
 
-    # Next, we subtract each position from the array of positions
-    # (atom_i, atom_j, positionvector, xhat)
-    pv = shifted_cart_coords - positions[:, None, None]
+    lower, upper: the bounds of the boxes. array-like (nboxes, 3)
+    cell: unit cell. array-like (3, 3)
 
-    # This is the distance squared
-    # (atom_i, atom_j, distance_ij)
-    d2 = np.sum(pv**2, axis=3)
+    Returns
+    -------
+    distances : array of shape (nboxes,)
+
+    """
+    best = np.full(len(lower), np.inf)
+    for pattern in itertools.product((0, 1, 2), repeat=3):
+        pattern = np.array(pattern)
+        free = pattern == 0
+        m = np.where(pattern == 1, lower, upper)
+        m[:, free] = 0.0
+
+        feasible = np.ones(len(lower), dtype=bool)
+        if free.any():
+            # minimize |m.dot(cell)|**2 over the free coordinates
+            A = cell[free]
+            c = np.dot(m, cell)
+            mf = -np.linalg.solve(np.dot(A, A.T), np.dot(A, c.T)).T
+            m[:, free] = mf
+            feasible = np.all((mf >= lower[:, free] - 1e-12) &
+                              (mf <= upper[:, free] + 1e-12), axis=1)
+
+        d = np.linalg.norm(np.dot(m, cell), axis=1)
+        best = np.where(feasible, np.minimum(best, d), best)
+    return best
+
+
+def _complete_cell(cell, pbc):
+    """Fill in zero cell vectors along non-periodic axes.
+
+    A slab or a cluster has no cell vector along its non-periodic axes, like
+    an ASE Atoms with a zero cell, but the neighbor search needs fractional
+    coordinates. Each missing vector is replaced by a unit vector that is
+    perpendicular to the given ones, which does not change the perpendicular
+    widths along the periodic axes.
+
+    Returns
+    -------
+    cell, pbc : the cell, unchanged if nothing is missing, and pbc as a boolean
+    array of shape (3,).
+
+    """
+    pbc = np.array(pbc, dtype=bool) & np.ones(3, dtype=bool)
+    value = np.array(getval(cell), dtype=float)
+    missing = ~pbc & ~value.any(axis=1)
+    if not missing.any():
+        return cell, pbc
+
+    # The right singular vectors past the rank span the missing directions.
+    present = value[~missing]
+    if len(present):
+        basis = np.linalg.svd(present)[2][len(present):]
+    else:
+        basis = np.eye(3)
+    filler = np.zeros((3, 3))
+    filler[missing] = basis
+    return cell + filler, pbc
+
+
+# The number of (atom_i, atom_j, offset) arrays of dtype that are alive at once
+# in a forces or stress evaluation, counting the (..., 3) pair vectors as
+# three. With cell offsets tracemalloc gives about 19 for both float64 and
+# float32. With the minimum image it gives up to 25 for float64 and 34 for
+# float32, because the (atom_i, atom_j, 3) position differences and shifts are
+# float64 for every dtype. This has some margin over all of them.
+PAIR_ARRAYS = 36
+
+
+def block_size(positions, cell, cutoff_radius, memory_budget,
+               strain=np.zeros((3, 3)), dtype=np.float64,
+               pbc=(True, True, True)):
+    """Return the number of atoms i per block that fits in memory_budget.
+
+    The block size is estimated for an energy, forces or stress evaluation
+    from `get_distances` with the atoms argument.
+
+    Parameters
+    ----------
+
+    positions: atomic positions. array-like (natoms, 3)
+    cell: unit cell. array-like (3, 3)
+    cutoff_radius: Maximum radius to get neighbor distances for. float
+    memory_budget: the peak memory in bytes for the pair arrays of one block.
+    strain: array-like (3, 3)
+    dtype: float type of the pair vectors and distances.
+    pbc: periodic boundary conditions, see `get_distances`.
+
+    Returns
+    -------
+    block_size : int, at least 1.
+
+    """
+    positions = getval(positions)
+    cell, pbc = _complete_cell(getval(cell), pbc)
+    strain_tensor = np.eye(3) + getval(strain)
+    cell = np.dot(strain_tensor, cell.T).T
+    positions = np.dot(strain_tensor, positions.T).T
+    inverse_cell = np.linalg.inv(cell)
+    wraps = np.floor(np.dot(positions, inverse_cell)) * pbc
+    positions = positions - np.dot(wraps, cell)
+    offsets = _offsets(positions, cell, cutoff_radius, pbc)
+    noffsets = 1 if offsets is None else len(offsets)
+
+    bytes_per_atom = (len(positions) * noffsets * PAIR_ARRAYS *
+                      np.dtype(dtype).itemsize)
+    return int(max(1, min(len(positions), memory_budget // bytes_per_atom)))
+
+
+def blocks(natoms, size=None):
+    """Return slices that split range(natoms) into blocks of size atoms.
+
+    With size None there is one block of all the atoms.
+    """
+    if size is None:
+        return [slice(None)]
+    return [slice(start, start + size) for start in range(0, natoms, size)]
+
+
+def pad_positions(positions):
+    """Stack a list of position arrays with different lengths.
+
+    Parameters
+    ----------
+
+    positions: a list of array-like (natoms_b, 3)
+
+    Returns
+    -------
+
+    positions, natoms : an array of shape (nbatch, max(natoms), 3) where the
+    missing atoms are zero, and an integer array of the atom counts.
+
+    """
+    natoms = np.array([len(p) for p in positions], dtype=int)
+    padded = np.zeros((len(positions), np.max(natoms), 3))
+    for b, p in enumerate(positions):
+        padded[b, :natoms[b]] = p
+    return padded, natoms
+
+
+def get_distances_batch(positions, cells, cutoff_radius, skin=0.01,
+                        natoms=None, dtype=np.float64):
+    """Get distances for a batch of periodic configurations in one pass.
+
+    This is a batched `get_distances`. All configurations share one set of cell
+    offsets, large enough for each of them.
+
+    Parameters
+    ----------
+
+    positions: atomic positions. array-like (nbatch, maxatoms, 3). Shorter
+    configurations are padded at the end.
+    cells: unit cells. array-like (nbatch, 3, 3)
+    cutoff_radius: Maximum radius to get neighbor distances for. float
+    skin: A tolerance for the cutoff_radius. float
+    natoms: The number of real atoms in each configuration. array-like
+    (nbatch,). Defaults to maxatoms for all of them.
+    dtype: float type of the pair vectors and distances, see `get_distances`.
+
+    Returns
+    -------
+
+    distances : an array of shape (nbatch, maxatoms, maxatoms, nunitcells).
+    Entries outside the cutoff radius or involving a padding atom are zeroed.
+    Like in `get_distances`, the atoms are wrapped into their unit cells
+    first.
+
+    """
+    t = instrument.tic()
+
+    nbatch, maxatoms = positions.shape[:2]
+    if natoms is None:
+        natoms = np.full(nbatch, maxatoms)
+    mask = np.arange(maxatoms)[None, :] < np.asarray(natoms)[:, None]
+
+    inverse_cells = np.linalg.inv(getval(cells))
+    num_repeats = cutoff_radius * np.linalg.norm(inverse_cells, axis=1)
+
+    # Wrap the real atoms into their unit cells, as in get_distances. This is
+    # a constant shift, so it does not change the gradients.
+    wraps = np.floor(np.einsum('bni,bij->bnj', getval(positions),
+                               inverse_cells)) * mask[:, :, None]
+    positions = positions - np.einsum('bni,bij->bnj', wraps, cells)
+
+    fractional_coords = np.einsum('bni,bij->bnj', getval(positions),
+                                  inverse_cells)
+    mins = np.min(np.floor(fractional_coords - num_repeats[:, None])[mask],
+                  axis=0)
+    maxs = np.max(np.ceil(fractional_coords + num_repeats[:, None])[mask],
+                  axis=0)
+
+    offsets = np.array(list(itertools.product(
+        *[np.arange(lo, hi) for lo, hi in zip(mins, maxs)])))
+
+    # (batch, offset_index, 3)
+    cart_offsets = np.einsum('ki,bij->bkj', offsets, cells).astype(dtype)
+    t = instrument.toc('offsets', t)
+
+    # (batch, atom_i, atom_j, 3)
+    dp = (positions[:, None] - positions[:, :, None]).astype(dtype)
+
+    # (batch, atom_i, atom_j, offset, 3)
+    pv = dp[:, :, :, None] + cart_offsets[:, None, None]
+
+    d2 = np.sum(pv**2, axis=4)
+    t = instrument.toc('distances', t)
 
     # The gradient of sqrt is nan at r=0, so we do this round about way to
-    # avoid that.
-    zeros = np.equal(d2, 0.0)
-    adjusted = np.where(zeros, np.ones_like(d2), d2)
-    d = np.where(zeros, np.zeros_like(d2), np.sqrt(adjusted))
+    # avoid that. The masks are multiplied in, see `get_distances`.
+    zeros = getval(d2) == 0.0
+    d = np.sqrt(d2 + zeros)
+
+    pair_mask = (mask[:, :, None] & mask[:, None, :])[..., None]
+    result = d * (pair_mask & ~zeros & (getval(d) <= cutoff_radius + skin))
+    instrument.toc('masking', t)
+
+    report = instrument.active()
+    if report is not None:
+        report.count('image_cells', nbatch * len(offsets))
+        report.count('candidate_pairs', np.size(getval(d2)))
+        report.count('pairs_in_cutoff', np.sum(getval(result) > 0))
+        report.add_bytes(pv, d2, d, result)
+
+    return result
+
+
+def get_neighbors_oneway_csr(positions, cell, cutoff_radius,
+                             skin=0.01,
+                             strain=np.zeros((3, 3)),
+                             pbc=(True, True, True)):
+    """A one-way neighbor list in flat CSR form.
+
+    Parameters
+    ----------
+
+    positions: atomic positions. array-like (natoms, 3)
+    cell: unit cell. array-like (3, 3)
+    cutoff_radius: Maximum radius to get neighbor distances for. float
+    skin: A tolerance for the cutoff_radius. float
+    strain: array-like (3, 3)
+    pbc: periodic boundary conditions, see `get_distances`.
+
+    Returns
+    -------
+    indptr, indices, offsets
 
-    return np.where(d <= cutoff_radius + skin, d, np.zeros_like(d))
+    The neighbors of atom a are indices[indptr[a]:indptr[a + 1]] and their
+    integer cell offsets are the same rows of offsets. The order is the same
+    as in `get_neighbors_oneway`.
+
+    """
+
+    cell, pbc = _complete_cell(cell, pbc)
+    strain_tensor = np.eye(3) + strain
+    cell = np.dot(strain_tensor, cell.T).T
+    positions = np.dot(strain_tensor, positions.T).T
+
+    inverse_cell = np.linalg.pinv(cell)
+
+    scaled = np.dot(positions, inverse_cell)
+    offsets = -(np.floor(scaled) * pbc).astype(int)
+    positions0 = positions + np.dot(offsets, cell)
+    natoms = len(positions)
+
+    # The candidates come from a slightly larger cutoff, so that the strict
+    # comparison below is the only one that decides the boundary.
+    a, i, n = _binned_pairs(positions0, cell, cutoff_radius * (1 + 1e-6),
+                            pbc)
+
+    d = positions0[i] + np.dot(n, cell) - positions0[a]
+    keep = (d**2).sum(1) < cutoff_radius**2
+
+    # Only offsets in one half-space are used, and in the home cell only the
+    # pairs with i > a.
+    n1, n2, n3 = n[:, 0], n[:, 1], n[:, 2]
+    keep &= ((n1 > 0) |
+             ((n1 == 0) & (n2 > 0)) |
+             ((n1 == 0) & (n2 == 0) & (n3 > 0)) |
+             ((n1 == 0) & (n2 == 0) & (n3 == 0) & (i > a)))
+    a, i, n = a[keep], i[keep], n[keep]
+
+    order = np.lexsort((i, n[:, 2], n[:, 1], n[:, 0], a))
+    a, i, n = a[order], i[order], n[order]
+
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(a, minlength=natoms))])
+    return indptr, i, n + offsets[i] - offsets[a]
 
 
 def get_neighbors_oneway(positions, cell, cutoff_radius,
                          skin=0.01,
-                         strain=np.zeros((3, 3))):
+                         strain=np.zeros((3, 3)),
+                         pbc=(True, True, True)):
     """A one-way neighbor list.
 
     Parameters
@@ -91,62 +464,325 @@ def get_neighbors_oneway(positions, cell, cutoff_radius,
     cutoff_radius: Maximum radius to get neighbor distances for. float
     skin: A tolerance for the cutoff_radius. float
     strain: array-like (3, 3)
+    pbc: periodic boundary conditions, see `get_distances`.
 
     Returns
     -------
     indices, offsets
 
     """
+    indptr, neighbors, displacements = get_neighbors_oneway_csr(
+        positions, cell, cutoff_radius, skin, strain, pbc)
+    return (np.split(neighbors, indptr[1:-1]),
+            np.split(displacements, indptr[1:-1]))
+
+
+def _binned_pairs(positions, cell, cutoff_radius, pbc=(True, True, True)):
+    """Find all pairs closer than cutoff_radius with a linked-cell search.
+
+    The atoms are wrapped into the unit cell and sorted into bins that are at
+    least cutoff_radius wide perpendicular to each cell face, so only a small
+    stencil of bins around each atom has to be searched. For a fixed density
+    and cutoff the work is O(natoms). Along a non-periodic axis the atoms are
+    not wrapped, the bins span the atoms instead of the cell, and there are no
+    images.
+
+    Parameters
+    ----------
+
+    positions: atomic positions. array-like (natoms, 3)
+    cell: unit cell. array-like (3, 3)
+    cutoff_radius: Maximum distance of a pair. float
+    pbc: periodic boundary conditions. array-like of 3 bools. The cell must
+    be invertible, see `_complete_cell`.
+
+    Returns
+    -------
+
+    i, j, offsets : arrays of shape (npairs,), (npairs,) and (npairs, 3). The
+    integer cell offsets are relative to the positions that were passed in, so
+    the vector from atom i to its neighbor is
+    positions[j] + offsets.dot(cell) - positions[i]. Both (i, j) and (j, i)
+    are returned, and an atom is never its own neighbor in the home cell.
+
+    """
+    t = instrument.tic()
+
+    positions = np.asarray(positions, dtype=float)
+    cell = np.asarray(cell, dtype=float)
+    pbc = np.array(pbc, dtype=bool) & np.ones(3, dtype=bool)
+    natoms = len(positions)
+
+    inverse_cell = np.linalg.inv(cell)
+    fractional_coords = np.dot(positions, inverse_cell)
+    wraps = (np.floor(fractional_coords) * pbc).astype(int)
+    fractional_coords = fractional_coords - wraps
+    positions0 = positions - np.dot(wraps, cell)
+
+    # Along non-periodic axes the bins cover the fractional range of the
+    # atoms, so the coordinates are rescaled to [0, 1] over it.
+    lower = np.where(pbc, 0.0, np.min(fractional_coords, axis=0,
+                                      initial=np.inf))
+    span = np.where(pbc, 1.0, np.maximum(
+        np.max(fractional_coords, axis=0, initial=-np.inf) - lower, 1e-12))
+    fractional_coords = (fractional_coords - lower) / span
+
+    # perpendicular widths of the binned region
+    h = span / np.linalg.norm(inverse_cell, axis=0)
+    nbins = np.maximum(1, (h / cutoff_radius).astype(int))
+    # number of bins to search on each side of the home bin. Without images
+    # there is nothing past the last bin.
+    nsearch = np.ceil(cutoff_radius * nbins / h).astype(int)
+    nsearch = np.where(pbc, nsearch, np.minimum(nsearch, nbins - 1))
+
+    bins = np.minimum((fractional_coords * nbins).astype(int), nbins - 1)
+
+    def bin_index(b):
+        return (b[..., 0] * nbins[1] + b[..., 1]) * nbins[2] + b[..., 2]
+
+    # Sort the atoms by bin so the atoms in a bin are contiguous.
+    atom_bins = bin_index(bins)
+    order = np.argsort(atom_bins, kind='mergesort')
+    counts = np.bincount(atom_bins, minlength=np.prod(nbins))
+    starts = np.cumsum(counts) - counts
+
+    stencil = np.array(list(itertools.product(
+        *[range(-n, n + 1) for n in nsearch])), dtype=int)
+
+    # (atom, stencil, 3) bins to search, and the image each one lies in.
+    search_bins = bins[:, None, :] + stencil[None, :, :]
+    images = np.floor_divide(search_bins, nbins).reshape(-1, 3)
+    search_bins = bin_index(np.mod(search_bins, nbins)).reshape(-1)
+    owner = np.repeat(np.arange(natoms), len(stencil))
+
+    # Bins past the ends of a non-periodic axis do not exist.
+    inside = np.all(pbc | (images == 0), axis=1)
+    images, search_bins, owner = (images[inside], search_bins[inside],
+                                  owner[inside])
+
+    # Expand every (atom, bin) into one candidate per atom in the bin.
+    ncandidates = counts[search_bins]
+    total = ncandidates.sum()
+    first = np.repeat(np.cumsum(ncandidates) - ncandidates, ncandidates)
+    within = np.arange(total) - first
+    i = np.repeat(owner, ncandidates)
+    j = order[np.repeat(starts[search_bins], ncandidates) + within]
+    images = np.repeat(images, ncandidates, axis=0)
+    t = instrument.toc('offsets', t)
+
+    d = positions0[j] + np.dot(images, cell) - positions0[i]
+    d2 = np.sum(d**2, axis=1)
+    t = instrument.toc('distances', t)
+
+    mask = d2 <= cutoff_radius**2
+    mask &= ~((i == j) & np.all(images == 0, axis=1))
+
+    report = instrument.active()
+    if report is not None:
+        report.count('image_cells', len(np.unique(images, axis=0)))
+        report.count('candidate_pairs', total)
+        report.count('pairs_in_cutoff', np.sum(mask))
+        report.add_bytes(i, j, images, d, d2)
+
+    i, j, images = i[mask], j[mask], images[mask]
+    offsets = images + wraps[i] - wraps[j]
+    instrument.toc('masking', t)
+    return i, j, offsets
+
+
+def _half_list(i, j, offsets):
+    """Keep one of the (i, j, offset) and (j, i, -offset) entries of a pair.
+
+    For i != j the entry with i < j is kept. An image of an atom itself is
+    kept when the first nonzero component of its offset is positive.
+    """
+    # the sign of the first nonzero offset component
+    sign = np.sign(offsets[np.arange(len(offsets)),
+                           np.argmax(offsets != 0, axis=1)])
+    keep = (i < j) | ((i == j) & (sign > 0))
+    return i[keep], j[keep], offsets[keep]
+
+
+def get_neighbors_binned(positions, cell, cutoff_radius, skin=0.01,
+                         strain=np.zeros((3, 3)), bothways=True,
+                         pbc=(True, True, True)):
+    """A linked-cell neighbor list.
+
+    This scales as O(natoms) for a fixed density and cutoff radius, so it is
+    the one to use for large systems.
+
+    Parameters
+    ----------
+
+    positions: atomic positions. array-like (natoms, 3)
+    cell: unit cell. array-like (3, 3)
+    cutoff_radius: Maximum radius to get neighbors for. float
+    skin: A tolerance for the cutoff_radius. float
+    strain: array-like (3, 3)
+    bothways: If False, each pair is only listed once. For i != j it is listed
+    on the atom with the smaller index, and an image of the atom itself is kept
+    when the first nonzero component of its offset is positive.
+    pbc: periodic boundary conditions, see `get_distances`.
+
+    Returns
+    -------
+    neighbors, displacements
+
+    neighbors[a] is an array of the indices of the neighbors of atom a, and
+    displacements[a] is the matching (nneighbors, 3) array of integer cell
+    offsets, so that the neighbor is at positions[j] + offset.dot(cell).
+
+    """
+    cell, pbc = _complete_cell(np.asarray(cell, dtype=float), pbc)
+    strain_tensor = np.eye(3) + strain
+    cell = np.dot(strain_tensor, cell.T).T
+    positions = np.dot(strain_tensor, np.asarray(positions).T).T
+    natoms = len(positions)
+
+    i, j, offsets = _binned_pairs(positions, cell, cutoff_radius + skin, pbc)
+
+    if not bothways:
+        i, j, offsets = _half_list(i, j, offsets)
+
+    order = np.lexsort((offsets[:, 2], offsets[:, 1], offsets[:, 0], j, i))
+    i, j, offsets = i[order], j[order], offsets[order]
 
+    splits = np.cumsum(np.bincount(i, minlength=natoms))[:-1]
+    return np.split(j, splits), np.split(offsets, splits)
+
+
+def get_pairs(positions, cell, cutoff_radius, skin=0.01,
+              strain=np.zeros((3, 3)), half=False, pbc=(True, True, True)):
+    """A neighbor list in sparse COO form.
+
+    Only the pairs inside the cutoff radius are stored, so memory scales with
+    the number of pairs instead of natoms**2 * nunitcells. The distances are
+    differentiable with autograd with respect to positions, cell and strain.
+
+    Parameters
+    ----------
+
+    positions: atomic positions. array-like (natoms, 3)
+    cell: unit cell. array-like (3, 3)
+    cutoff_radius: Maximum radius to get neighbor distances for. float
+    skin: A tolerance for the cutoff_radius. float
+    strain: array-like (3, 3)
+    half: If True, each pair is only listed once, with i < j. An image of an
+    atom itself is kept when the first nonzero component of its offset is
+    positive.
+    pbc: periodic boundary conditions, see `get_distances`.
+
+    Returns
+    -------
+
+    i, j, offsets, distances : arrays of shape (npairs,), (npairs,),
+    (npairs, 3) and (npairs,). The neighbor of atom i is at
+    positions[j] + offsets.dot(cell), both strained. The offsets are zero
+    along non-periodic axes.
+
+    """
+    cell, pbc = _complete_cell(cell, pbc)
     strain_tensor = np.eye(3) + strain
     cell = np.dot(strain_tensor, cell.T).T
     positions = np.dot(strain_tensor, positions.T).T
 
-    inverse_cell = np.linalg.pinv(cell)
-    h = 1 / np.linalg.norm(inverse_cell, axis=0)
-    N = (2 * cutoff_radius / h).astype(int) + 1
+    i, j, offsets = _binned_pairs(getval(positions), getval(cell),
+                                  getval(cutoff_radius + skin), pbc)
+    if half:
+        i, j, offsets = _half_list(i, j, offsets)
 
-    scaled = np.dot(positions, inverse_cell)
-    scaled0 = scaled.copy() % 1.0
+    return i, j, offsets, _pair_distances(positions, cell, i, j, offsets)
 
-    offsets = (scaled0 - scaled).round().astype(int)
-    positions0 = positions + np.dot(offsets, cell)
-    natoms = len(positions)
-    indices = np.arange(natoms)
-
-    v0_range = np.arange(0, N[0] + 1)
-    v1_range = np.arange(-N[1], N[1] + 1)
-    v2_range = np.arange(-N[2], N[2] + 1)
-
-    xhat = np.array([1, 0, 0])
-    yhat = np.array([0, 1, 0])
-    zhat = np.array([0, 0, 1])
-
-    v0_range = v0_range[:, None] * xhat[None, :]
-    v1_range = v1_range[:, None] * yhat[None, :]
-    v2_range = v2_range[:, None] * zhat[None, :]
-
-    N = (v0_range[:, None, None] +
-         v1_range[None, :, None] +
-         v2_range[None, None, :])
-
-    N = N.reshape(-1, 3)
-
-    neighbors = [np.empty(0, int) for a in range(natoms)]
-    displacements = [np.empty((0, 3), int) for a in range(natoms)]
-
-    for n1, n2, n3 in N:
-        if n1 == 0 and (n2 < 0 or (n2 == 0 and n3 < 0)):
-            continue
-        displacement = np.dot((n1, n2, n3), cell)
-        for a in range(natoms):
-            d = positions0 + displacement - positions0[a]
-            i = indices[(d**2).sum(1) < (cutoff_radius)**2]
-            if n1 == 0 and n2 == 0 and n3 == 0:
-                i = i[i > a]
-            neighbors[a] = np.concatenate((neighbors[a], i))
-            disp = np.empty((len(i), 3), int)
-            disp[:] = (n1, n2, n3)
-            disp += offsets[i] - offsets[a]
-            displacements[a] = np.concatenate((displacements[a], disp))
-    return neighbors, displacements
+
+def _pair_distances(positions, cell, i, j, offsets):
+    """Differentiable distances of the pairs (i, j, offsets)."""
+    d = positions[j] + np.dot(offsets, cell) - positions[i]
+    return np.sqrt(np.sum(d**2, axis=1))
+
+
+class NeighborList:
+    """A Verlet neighbor list that is reused while the atoms stay in the skin.
+
+    The pairs are found with `get_pairs` at cutoff_radius + skin. They are
+    reused until some atom has moved more than skin / 2 since the last build,
+    or the cell, the strain, pbc or the number of atoms changes. Until then, no
+    pair that is inside cutoff_radius can be missing from the list.
+
+    Parameters
+    ----------
+
+    cutoff_radius: Radius the list has to be complete for. float
+    skin: Extra radius that is searched so the list can be reused. float
+    half: If True, each pair is only listed once. See `get_pairs`.
+
+    Attributes
+    ----------
+
+    nrebuilds: number of times the pairs were searched for.
+    nreuses: number of updates that reused the previous pairs.
+
+    """
+
+    def __init__(self, cutoff_radius, skin=0.3, half=True):
+        self.cutoff_radius = cutoff_radius
+        self.skin = skin
+        self.half = half
+
+        self.nrebuilds = 0
+        self.nreuses = 0
+
+        self.i = self.j = self.offsets = None
+        self._positions = self._cell = self._strain = self._pbc = None
+
+    def update(self, positions, cell, strain=np.zeros((3, 3)),
+               pbc=(True, True, True)):
+        """Rebuild the list if it is needed.
+
+        Returns True if the list was rebuilt, and False if it was reused.
+        """
+        cell = np.array(getval(cell), dtype=float)
+        strain = np.array(getval(strain), dtype=float)
+        pbc = np.array(pbc, dtype=bool) & np.ones(3, dtype=bool)
+
+        strain_tensor = np.eye(3) + strain
+        strained_positions = np.dot(strain_tensor, getval(positions).T).T
+
+        if (self._positions is not None and
+                len(strained_positions) == len(self._positions) and
+                np.array_equal(cell, self._cell) and
+                np.array_equal(strain, self._strain) and
+                np.array_equal(pbc, self._pbc)):
+            moved = np.sum((strained_positions - self._positions)**2, axis=1)
+            if np.max(moved, initial=0.0) <= (self.skin / 2)**2:
+                self.nreuses += 1
+                return False
+
+        i, j, offsets, _ = get_pairs(strained_positions,
+                                     np.dot(strain_tensor, cell.T).T,
+                                     self.cutoff_radius, self.skin,
+                                     half=self.half, pbc=pbc)
+        self.i, self.j, self.offsets = i, j, offsets
+        self._positions = strained_positions
+        self._cell = cell
+        self._strain = strain
+        self._pbc = pbc
+        self.nrebuilds += 1
+        return True
+
+    def get_pairs(self, positions, cell, strain=np.zeros((3, 3)),
+                  pbc=(True, True, True)):
+        """Update the list and return the pairs with their distances.
+
+        This returns the same i, j, offsets, distances as `get_pairs`, but
+        some of the pairs may be up to skin beyond the cutoff radius. The
+        distances are differentiable with autograd.
+        """
+        self.update(positions, cell, strain, pbc)
+
+        strain_tensor = np.eye(3) + strain
+        cell = np.dot(strain_tensor, cell.T).T
+        positions = np.dot(strain_tensor, positions.T).T
+
+        distances = _pair_distances(positions, cell, self.i, self.j,
+                                    self.offsets)
+        return self.i, self.j, self.offsets, distances
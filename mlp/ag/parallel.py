@@ -0,0 +1,161 @@
+"""Parallel evaluation of a training objective across structures.
+
+The structures are split into one contiguous shard per process. The worker
+processes are started once and keep their shard of positions, cells and
+reference energies, so each evaluation only sends the parameters to them and
+gets back a partial loss and its gradient. The partial results are reduced in
+shard order, so the result does not depend on which worker finishes first.
+
+An exception in a worker is sent back and raised again in the parent, with
+the traceback from the worker as its cause.
+
+"""
+import multiprocessing
+import traceback
+import autograd.numpy as np
+from autograd import value_and_grad
+from mlp.ag.lennardjones import energy_batch
+
+
+def _partial_loss(params, positions, cells, energies, loss):
+    """Sum of the per-structure losses of a shard."""
+    errs = energy_batch(params, positions, cells) - energies
+    if loss == 'mae':
+        return np.sum(np.abs(errs))
+    return np.sum(errs**2)
+
+
+def _worker(connection, positions, cells, energies, loss):
+    f = value_and_grad(_partial_loss)
+    while True:
+        params = connection.recv()
+        if params is None:
+            break
+        try:
+            value, gradient = f(params, positions, cells, energies, loss)
+            connection.send((float(value),
+                             {key: float(v) for key, v in gradient.items()},
+                             None))
+        except Exception as error:
+            remote = traceback.format_exc()
+            try:
+                connection.send((None, None, (error, remote)))
+            except Exception:
+                # the exception could not be pickled
+                connection.send((None, None, (RuntimeError(remote), remote)))
+    connection.close()
+
+
+class _RemoteTraceback(Exception):
+    """The traceback of an exception in a worker process."""
+
+    def __str__(self):
+        return self.args[0]
+
+
+class ParallelObjective:
+    """A training objective evaluated by a pool of worker processes.
+
+    The objective is the mean absolute error ('mae') or the mean squared error
+    ('mse') of the `energy_batch` energies over all the structures.
+
+    Parameters
+    ----------
+
+    positions : a list of arrays with shape (natoms_b, 3)
+
+    cells: a list of unit cells. Shape = (3, 3) each
+
+    energies: the reference energies. Shape = (nstructures,)
+
+    nprocs: number of worker processes. Defaults to the number of cpus.
+
+    loss: 'mae' or 'mse'.
+
+    Use it as a context manager, or call close, to stop the workers. The
+    __call__ and grad methods take (params, step) like the objective functions
+    used with autograd.misc.optimizers.
+
+    """
+
+    def __init__(self, positions, cells, energies, nprocs=None, loss='mae'):
+        if loss not in ('mae', 'mse'):
+            raise ValueError('Unknown loss {!r}. Use "mae" or "mse".'.format(
+                loss))
+
+        energies = np.asarray(energies, dtype=float)
+        self.nstructures = len(energies)
+
+        if nprocs is None:
+            nprocs = multiprocessing.cpu_count()
+        nprocs = max(1, min(nprocs, self.nstructures))
+
+        self.connections, self.processes = [], []
+        for shard in np.array_split(np.arange(self.nstructures), nprocs):
+            parent, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=_worker,
+                args=(child,
+                      [np.asarray(positions[k], dtype=float) for k in shard],
+                      np.array([cells[k] for k in shard], dtype=float),
+                      energies[shard],
+                      loss))
+            process.daemon = True
+            process.start()
+            child.close()
+            self.connections += [parent]
+            self.processes += [process]
+
+        # The last (params, value, gradient), so that __call__ and grad at the
+        # same params only evaluate the objective once.
+        self._last = None
+
+    def value_and_grad(self, params):
+        """Return the objective and its gradient with respect to params."""
+        params = {key: float(value) for key, value in params.items()}
+        if self._last is not None and self._last[0] == params:
+            return self._last[1], dict(self._last[2])
+
+        try:
+            for connection in self.connections:
+                connection.send(params)
+            results = [connection.recv() for connection in self.connections]
+        except (EOFError, OSError) as error:
+            raise RuntimeError('A worker process exited unexpectedly.') \
+                from error
+
+        for _, _, failure in results:
+            if failure is not None:
+                error, remote = failure
+                raise error from _RemoteTraceback(remote)
+
+        value = sum(result[0] for result in results) / self.nstructures
+        gradient = {key: np.array(sum(result[1][key] for result in results) /
+                                  self.nstructures)
+                    for key in params}
+        self._last = (params, value, gradient)
+        return value, dict(gradient)
+
+    def __call__(self, params, step=None):
+        return self.value_and_grad(params)[0]
+
+    def grad(self, params, step=None):
+        return self.value_and_grad(params)[1]
+
+    def close(self):
+        """Stop the worker processes. Workers that already died are skipped."""
+        for connection in self.connections:
+            try:
+                connection.send(None)
+            except OSError:
+                pass
+            connection.close()
+        for process in self.processes:
+            process.join()
+        self.connections, self.processes = [], []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
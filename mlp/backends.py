@@ -0,0 +1,22 @@
+"""Lazy imports of the optional dependencies.
+
+The autograd code in `mlp.ag` does not need TensorFlow, and most of it does
+not need ASE. Modules that can use them get them from `require` inside the
+functions that need them, so importing e.g. `mlp.ag.lennardjones` never pays
+for TensorFlow's startup time or memory.
+
+"""
+import importlib
+
+
+def require(module):
+    """Import and return a third party module, like tensorflow or ase.db.
+
+    Call this where the module is used rather than at the top of a module, so
+    the import only happens when it is needed.
+    """
+    try:
+        return importlib.import_module(module)
+    except ImportError as e:
+        raise ImportError('{} is required for this, but it could not be '
+                          'imported: {}'.format(module, e))
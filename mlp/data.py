@@ -0,0 +1,196 @@
+"""Training datasets stored as contiguous arrays.
+
+An ase.db is converted once with `write`, which stores all the structures in a
+directory of .npy files. `Dataset` opens them memory-mapped, so loading a large
+database only pages in the arrays that are used, and there is no SQLite or
+ase.Atoms overhead after the conversion.
+
+The atoms of all structures are stacked in one array, and structure k owns the
+rows offsets[k]:offsets[k + 1] of positions, numbers and forces.
+
+"""
+import json
+import os
+import numpy as np
+from mlp.backends import require
+
+ARRAYS = ('positions', 'numbers', 'forces', 'cells', 'pbc', 'energies',
+          'offsets')
+
+
+def write(db, directory):
+    """Convert an ase.db to a dataset directory.
+
+    Parameters
+    ----------
+
+    db : an ase.db connection, or the filename of one.
+
+    directory : where to write the arrays. It is created if needed.
+
+    Returns
+    -------
+    A Dataset for the new directory.
+
+    """
+    if isinstance(db, str):
+        db = require('ase.db').connect(db)
+
+    positions, numbers, forces = [], [], []
+    cells, pbc, energies, natoms = [], [], [], []
+    key_value_pairs = []
+
+    for row in db.select():
+        positions += [row.positions]
+        numbers += [row.numbers]
+        f = row.get('forces')
+        forces += [np.full((row.natoms, 3), np.nan) if f is None else f]
+        cells += [row.cell]
+        pbc += [row.pbc]
+        e = row.get('energy')
+        energies += [np.nan if e is None else e]
+        natoms += [row.natoms]
+        key_value_pairs += [row.key_value_pairs]
+
+    arrays = {'positions': np.concatenate(positions).reshape(-1, 3),
+              'numbers': np.concatenate(numbers).astype(int),
+              'forces': np.concatenate(forces).reshape(-1, 3),
+              'cells': np.array(cells, dtype=float).reshape(-1, 3, 3),
+              'pbc': np.array(pbc, dtype=bool).reshape(-1, 3),
+              'energies': np.array(energies, dtype=float),
+              'offsets': np.concatenate([[0], np.cumsum(natoms)]).astype(int)}
+
+    # One column per key. Strings are stored as unicode arrays with '' for
+    # missing values, and everything else as floats with nan.
+    keys = sorted(set(k for kvp in key_value_pairs for k in kvp))
+    for key in keys:
+        values = [kvp.get(key) for kvp in key_value_pairs]
+        if any(isinstance(v, str) for v in values):
+            column = np.array(['' if v is None else str(v) for v in values])
+        else:
+            column = np.array([np.nan if v is None else v for v in values],
+                              dtype=float)
+        arrays['key_' + key] = column
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    for name, array in arrays.items():
+        np.save(os.path.join(directory, name + '.npy'), array)
+
+    with open(os.path.join(directory, 'metadata.json'), 'w') as f:
+        f.write(json.dumps({'nstructures': len(energies),
+                            'keys': keys}))
+
+    return Dataset(directory)
+
+
+class Dataset:
+    """A memory-mapped dataset written by `write`.
+
+    Parameters
+    ----------
+
+    directory : the dataset directory.
+
+    mmap_mode : passed to numpy.load. Use None to read everything into
+      memory.
+
+    Indexing with an integer returns a dictionary of the arrays of one
+    structure. The per-atom arrays are slices of the memory map, so nothing is
+    copied. Indexing with a slice or an index array, and `select`, return a new
+    Dataset that shares the same arrays.
+
+    """
+
+    def __init__(self, directory, mmap_mode='r'):
+        self.directory = directory
+
+        with open(os.path.join(directory, 'metadata.json')) as f:
+            metadata = json.loads(f.read())
+        self.keys = metadata['keys']
+
+        self._arrays = {}
+        for name in list(ARRAYS) + ['key_' + key for key in self.keys]:
+            self._arrays[name] = np.load(os.path.join(directory,
+                                                      name + '.npy'),
+                                         mmap_mode=mmap_mode)
+
+        self.index = np.arange(metadata['nstructures'])
+
+    def _view(self, index):
+        view = object.__new__(Dataset)
+        view.directory = self.directory
+        view.keys = self.keys
+        view._arrays = self._arrays
+        view.index = index
+        return view
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, k):
+        if isinstance(k, (int, np.integer)):
+            s = self.index[k]
+            start, stop = self._arrays['offsets'][s:s + 2]
+            # np.asarray drops the memmap subclass, which autograd cannot
+            # differentiate, without copying the data.
+            arrays = self._arrays
+            structure = {'positions': np.asarray(
+                             arrays['positions'][start:stop]),
+                         'numbers': np.asarray(arrays['numbers'][start:stop]),
+                         'forces': np.asarray(arrays['forces'][start:stop]),
+                         'cell': np.asarray(arrays['cells'][s]),
+                         'pbc': np.asarray(arrays['pbc'][s]),
+                         'energy': float(arrays['energies'][s])}
+            for key in self.keys:
+                structure[key] = self._arrays['key_' + key][s]
+            return structure
+        return self._view(self.index[k])
+
+    def select(self, **kwargs):
+        """Return the structures whose key-value pairs match kwargs.
+
+        For example dataset.select(structure='fcc', f=1.0).
+        """
+        mask = np.ones(len(self.index), dtype=bool)
+        for key, value in kwargs.items():
+            if key not in self.keys:
+                raise KeyError('Unknown key {!r}'.format(key))
+            mask &= self._arrays['key_' + key][self.index] == value
+        return self._view(self.index[mask])
+
+    def get(self, key):
+        """Return the values of a key-value pair for all the structures."""
+        return self._arrays['key_' + key][self.index]
+
+    @property
+    def natoms(self):
+        return np.diff(self._arrays['offsets'])[self.index]
+
+    @property
+    def energies(self):
+        return self._arrays['energies'][self.index]
+
+    @property
+    def cells(self):
+        return self._arrays['cells'][self.index]
+
+    @property
+    def positions(self):
+        """A list of the position arrays. They are views of the memory map."""
+        return [self[k]['positions'] for k in range(len(self))]
+
+    @property
+    def forces(self):
+        """A list of the force arrays. They are views of the memory map."""
+        return [self[k]['forces'] for k in range(len(self))]
+
+    def toatoms(self, k):
+        """Return structure k as an ase.Atoms object."""
+        Atoms = require('ase').Atoms
+        structure = self[k]
+        return Atoms(numbers=structure['numbers'],
+                     positions=structure['positions'],
+                     cell=structure['cell'],
+                     pbc=structure['pbc'])
@@ -1,17 +1,17 @@
 """A sanity module.
 
-This contains simple functions that should work.
+This contains simple functions that should work. ASE and TensorFlow are only
+imported when the functions that use them are called.
 """
 
-import ase
-import tensorflow as tf
+from mlp.backends import require
 
 
 def sanity0():
     """Sanity check function to make sure we are running tests."""
-    from ase.build import bulk
+    ase = require('ase')
     print(ase.__version__)
-    atoms = bulk('Cu', 'fcc', a=3.6).repeat((2, 1, 1))
+    atoms = require('ase.build').bulk('Cu', 'fcc', a=3.6).repeat((2, 1, 1))
     atoms.get_volume()
     # This sanity function just returns 2
     return 2
@@ -19,5 +19,6 @@ def sanity0():
 
 def sanity1():
     """Sanity function to see if tensorflow is working."""
+    tf = require('tensorflow')
     a = tf.constant(1)
     return 2 * a
@@ -1,11 +1,24 @@
 import unittest
+import warnings
 import autograd.numpy as np
-from ase.build import bulk
+from autograd import grad
+from ase.build import bulk, fcc111
+from ase.cluster import Icosahedron
 from ase.neighborlist import NeighborList
 from ase.calculators.lj import LennardJones
+from ase.calculators.calculator import PropertyNotImplementedError
 
-from mlp.ag.neighborlist import get_distances, get_neighbors_oneway
-from mlp.ag.lennardjones import energy, forces, stress
+from mlp.ag.neighborlist import (get_distances, get_neighbors_oneway,
+                                 get_neighbors_oneway_csr,
+                                 get_neighbors_binned, get_pairs,
+                                 block_size)
+from mlp.ag.neighborlist import NeighborList as VerletList
+from mlp.ag.lennardjones import (energy, forces, stress, energy_sparse,
+                                 forces_sparse, stress_sparse,
+                                 energy_forces_stress, energy_batch,
+                                 hessian, hessian_vector_product,
+                                 DistanceMoments)
+from mlp.ag.montecarlo import IncrementalEnergy
 
 
 class TestNeighborList(unittest.TestCase):
@@ -37,6 +50,67 @@ class TestNeighborList(unittest.TestCase):
 
                 self.assertTrue(np.all(nns_ase == nns))
 
+    def test_images(self):
+        "Sheared cells with pruned images, and the minimum image shortcut."
+        for shear, cutoff_radius in ((0.8, 10.2), (1.5, 10.2), (0.0, 4.5)):
+            atoms = bulk('Ar', 'fcc', a=5.26, cubic=True).repeat((2, 2, 2))
+            cell = np.array(atoms.cell)
+            cell[1] += shear * cell[0]
+            cell[2] += 0.5 * shear * cell[1]
+            atoms.set_cell(cell, scale_atoms=True)
+            atoms.rattle(0.1)
+            # an atom outside of the unit cell
+            atoms.positions[0] -= cell[2]
+
+            nl = NeighborList([cutoff_radius / 2] * len(atoms), skin=0.005,
+                              self_interaction=False, bothways=True)
+            nl.update(atoms)
+            nns_ase = [len(nl.get_neighbors(i)[0])
+                       for i in range(len(atoms))]
+
+            d = get_distances(atoms.positions, atoms.cell, cutoff_radius)
+            if shear == 0.0:
+                self.assertEqual(d.shape[2], 1)
+            nns = ((d <= (cutoff_radius + 0.01)) & (d > 0.00)).sum((1, 2))
+            self.assertTrue(np.all(nns_ase == nns))
+
+    def test_pbc(self):
+        "A slab and a cluster, with and without zero cell vectors."
+        cutoff_radius = 4.0
+        slab = fcc111('Cu', (2, 2, 3), a=3.7, vacuum=1.0)
+        cluster = Icosahedron('Cu', 2, latticeconstant=3.7)
+        cluster.set_cell(np.zeros((3, 3)))
+        for atoms in (slab, cluster):
+            atoms.rattle(0.05)
+            nl = NeighborList([cutoff_radius / 2] * len(atoms), skin=0.0,
+                              self_interaction=False, bothways=True)
+            nl.update(atoms)
+            nns_ase = [len(nl.get_neighbors(i)[0])
+                       for i in range(len(atoms))]
+
+            cell = np.array(atoms.cell)
+            zero_cell = np.where(atoms.pbc[:, None], cell, 0.0)
+            for c in (cell, zero_cell):
+                d = get_distances(atoms.positions, c, cutoff_radius, 0.0,
+                                  pbc=atoms.pbc)
+                nns = (d > 0.0).sum((1, 2))
+                self.assertTrue(np.all(nns_ase == nns))
+
+                i, _, offsets, _ = get_pairs(atoms.positions, c,
+                                             cutoff_radius, 0.0,
+                                             pbc=atoms.pbc)
+                nns = np.bincount(i, minlength=len(atoms))
+                self.assertTrue(np.all(nns_ase == nns))
+                self.assertTrue(np.all(offsets[:, ~atoms.pbc] == 0))
+
+                indptr, _, _ = get_neighbors_oneway_csr(
+                    atoms.positions, c, cutoff_radius, 0.0, pbc=atoms.pbc)
+                self.assertEqual(2 * indptr[-1], np.sum(nns_ase))
+
+        # without pbc the slab would see its images through the thin vacuum
+        d = get_distances(slab.positions, slab.cell, cutoff_radius, 0.0)
+        self.assertGreater((d > 0.0).sum(), np.sum(nns_ase))
+
 
 class TestNeighborListOneWay(unittest.TestCase):
     def test0(self):
@@ -69,6 +143,136 @@ class TestNeighborListOneWay(unittest.TestCase):
 
                     # I am not sure how to test for the displacements.
 
+    def test_csr(self):
+        "The CSR arrays hold the same list, and the offsets are in range."
+        atoms = bulk('Cu', 'hcp', a=3.6).repeat((2, 1, 2))
+        atoms.rattle(0.1)
+        cutoff_radius = 7.0
+        neighbors, displacements = get_neighbors_oneway(atoms.positions,
+                                                        atoms.cell,
+                                                        cutoff_radius)
+        indptr, indices, offsets = get_neighbors_oneway_csr(atoms.positions,
+                                                            atoms.cell,
+                                                            cutoff_radius)
+        self.assertEqual(len(indptr), len(atoms) + 1)
+        for a in range(len(atoms)):
+            self.assertTrue(np.all(neighbors[a] ==
+                                   indices[indptr[a]:indptr[a + 1]]))
+            self.assertTrue(np.all(displacements[a] ==
+                                   offsets[indptr[a]:indptr[a + 1]]))
+
+        a = np.repeat(np.arange(len(atoms)), np.diff(indptr))
+        d = (atoms.positions[indices] + np.dot(offsets, atoms.cell) -
+             atoms.positions[a])
+        self.assertTrue(np.all(np.linalg.norm(d, axis=1) < cutoff_radius))
+
+
+class TestNeighborListBinned(unittest.TestCase):
+    def test0(self):
+        "Check a variety of repeats against ase."
+        a = 3.6
+        for cutoff_radius in np.linspace(a / 2, 5 * a, 10):
+            for rep in ((1, 1, 1),
+                        (2, 1, 1),
+                        (1, 2, 1),
+                        (1, 1, 2),
+                        (2, 2, 1),
+                        (1, 2, 3)):
+                atoms = bulk('Cu', 'fcc', a=a).repeat(rep)
+
+                nl = NeighborList([cutoff_radius / 2] * len(atoms), skin=0.01,
+                                  self_interaction=False, bothways=True)
+                nl.update(atoms)
+
+                neighbors, displacements = get_neighbors_binned(
+                    atoms.positions, atoms.cell, cutoff_radius)
+
+                for i in range(len(atoms)):
+                    an, ad = nl.get_neighbors(i)
+                    self.assertCountEqual(neighbors[i], an)
+                    self.assertCountEqual([tuple(d) for d in displacements[i]],
+                                          [tuple(d) for d in ad])
+
+    def test_strain(self):
+        "Check a sheared triclinic cell against get_distances."
+        strain = np.array([[0.0, 0.2, 0.0],
+                           [0.0, 0.0, 0.0],
+                           [0.1, 0.0, -0.05]])
+        for struct in ['fcc', 'hcp']:
+            atoms = bulk('Cu', struct, a=3.6).repeat((2, 1, 2))
+            atoms.rattle(0.05)
+            for cutoff_radius in [2.0, 4.5, 7.0]:
+                d = get_distances(atoms.positions, atoms.cell, cutoff_radius,
+                                  strain=strain)
+                nns = ((d > 0) & (d <= cutoff_radius + 0.01)).sum((1, 2))
+
+                neighbors, _ = get_neighbors_binned(atoms.positions,
+                                                    atoms.cell, cutoff_radius,
+                                                    strain=strain)
+                self.assertTrue(np.all(nns == [len(n) for n in neighbors]))
+
+                oneway, _ = get_neighbors_binned(atoms.positions, atoms.cell,
+                                                 cutoff_radius, strain=strain,
+                                                 bothways=False)
+                self.assertEqual(2 * sum(len(n) for n in oneway), nns.sum())
+
+
+class TestPairs(unittest.TestCase):
+    def test_pairs(self):
+        "Check the COO pair list against get_distances."
+        atoms = bulk('Cu', 'fcc', a=3.6).repeat((1, 2, 3))
+        atoms.rattle(0.05)
+        cutoff_radius = 6.0
+        d = get_distances(atoms.positions, atoms.cell, cutoff_radius)
+        ref = np.sort(d[d > 0])
+
+        i, j, offsets, distances = get_pairs(atoms.positions, atoms.cell,
+                                             cutoff_radius)
+        self.assertTrue(np.allclose(np.sort(distances), ref))
+
+        i, j, offsets, distances = get_pairs(atoms.positions, atoms.cell,
+                                             cutoff_radius, half=True)
+        self.assertTrue(np.all(i <= j))
+        self.assertTrue(np.allclose(np.sort(np.concatenate([distances,
+                                                            distances])),
+                                    ref))
+
+
+class TestVerletNeighborList(unittest.TestCase):
+    def test_reuse(self):
+        "The list is reused for small moves and agrees with a fresh one."
+        atoms = bulk('Cu', 'fcc', a=3.7).repeat((2, 2, 2))
+        atoms.rattle(0.02)
+        positions, cell = atoms.positions.copy(), atoms.cell
+
+        nl = VerletList(3.0, skin=0.3)
+        rng = np.random.RandomState(42)
+        for step in range(10):
+            positions = positions + rng.normal(scale=0.01,
+                                               size=positions.shape)
+            self.assertAlmostEqual(energy_sparse({}, positions, cell,
+                                                 neighborlist=nl),
+                                   energy_sparse({}, positions, cell))
+            self.assertTrue(np.allclose(forces_sparse({}, positions, cell,
+                                                      nl),
+                                        forces_sparse({}, positions, cell)))
+        self.assertEqual(nl.nrebuilds, 1)
+        self.assertEqual(nl.nreuses, 19)
+
+        # a large move, a new cell and a strain all force a rebuild
+        positions[0] += 0.2
+        self.assertTrue(nl.update(positions, cell))
+        self.assertTrue(nl.update(positions, 1.01 * cell))
+        self.assertTrue(nl.update(positions, 1.01 * cell, 0.01 * np.eye(3)))
+        self.assertFalse(nl.update(positions, 1.01 * cell, 0.01 * np.eye(3)))
+        self.assertEqual(nl.nrebuilds, 4)
+
+    def test_cutoff(self):
+        atoms = bulk('Cu', 'fcc', a=3.7)
+        with self.assertRaises(ValueError):
+            energy_sparse({}, atoms.positions, atoms.cell,
+                          neighborlist=VerletList(2.0))
+
 
 class TestLennardJones(unittest.TestCase):
     def test_fcc(self):
@@ -97,3 +301,503 @@ class TestLennardJones(unittest.TestCase):
 
                 self.assertTrue(np.allclose(atoms.get_stress(),
                                             lj_stress))
+
+    def test_pbc(self):
+        "A slab and a cluster compared to ase."
+        slab = fcc111('Cu', (2, 2, 3), a=3.7, vacuum=1.0)
+        cluster = Icosahedron('Cu', 2, latticeconstant=3.7)
+        cluster.set_cell(np.zeros((3, 3)))
+        for atoms in (slab, cluster):
+            atoms.rattle(0.02)
+            atoms.set_calculator(LennardJones())
+            ase_energy = atoms.get_potential_energy()
+            ase_forces = atoms.get_forces()
+            pbc = atoms.pbc
+            cell = np.array(atoms.cell)
+
+            self.assertAlmostEqual(ase_energy,
+                                   energy({}, atoms.positions, cell, pbc=pbc))
+            self.assertAlmostEqual(
+                ase_energy,
+                energy_sparse({}, atoms.positions, cell, pbc=pbc))
+            for backend in ('autograd', 'analytic'):
+                f = forces({}, atoms.positions, cell, backend, pbc=pbc)
+                self.assertTrue(np.allclose(ase_forces, f))
+            self.assertTrue(np.allclose(
+                ase_forces,
+                forces_sparse({}, atoms.positions, cell, pbc=pbc)))
+
+        self.assertTrue(np.allclose(
+            slab.get_stress(),
+            stress({}, slab.positions, np.array(slab.cell), pbc=slab.pbc)))
+        self.assertTrue(np.allclose(
+            slab.get_stress(),
+            stress_sparse({}, slab.positions, np.array(slab.cell),
+                          pbc=slab.pbc)))
+
+        # the cluster has no volume, which is not an error
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            for backend in ('autograd', 'analytic'):
+                s = stress({}, cluster.positions, cluster.cell, backend=backend,
+                           pbc=cluster.pbc)
+                self.assertFalse(np.any(np.isfinite(s)))
+            s = stress_sparse({}, cluster.positions, cluster.cell,
+                              pbc=cluster.pbc)
+            self.assertFalse(np.any(np.isfinite(s)))
+
+    def test_float32(self):
+        "float32 pair terms agree with float64 within the documented bounds."
+        for struct in ['fcc', 'bcc', 'diamond']:
+            atoms = bulk('Cu', struct, a=3.7).repeat((1, 2, 3))
+            atoms.rattle(0.02)
+            p, c = atoms.positions, atoms.cell
+
+            d = get_distances(p, c, 3.0, dtype=np.float32)
+            self.assertEqual(d.dtype, np.float32)
+
+            self.assertAlmostEqual(energy({}, p, c),
+                                   energy({}, p, c, dtype=np.float32),
+                                   delta=1e-6)
+            self.assertTrue(np.allclose(forces({}, p, c),
+                                        forces({}, p, c, dtype=np.float32),
+                                        rtol=0, atol=1e-6))
+            self.assertTrue(np.allclose(stress({}, p, c),
+                                        stress({}, p, c, dtype=np.float32),
+                                        rtol=0, atol=1e-7))
+            self.assertTrue(np.allclose(
+                energy_batch({}, [p, p], [c, c]),
+                energy_batch({}, [p, p], [c, c], dtype=np.float32),
+                rtol=0, atol=1e-6))
+
+    def test_blocks(self):
+        "Blocks of atoms give the same results within the memory budget."
+        atoms = bulk('Ar', 'fcc', a=5.26, cubic=True).repeat((2, 2, 2))
+        atoms.rattle(0.05)
+        params = {'sigma': 3.4, 'epsilon': 0.0104}
+        p, c = atoms.positions, atoms.cell
+        strain = np.array([[0.01, 0.002, 0.0],
+                           [0.002, -0.01, 0.003],
+                           [0.0, 0.003, 0.005]])
+
+        d = get_distances(p, c, 10.2, atoms=slice(5, 12))
+        self.assertTrue(np.allclose(d, get_distances(p, c, 10.2)[5:12]))
+
+        size = block_size(p, c, 10.2, 1e6)
+        self.assertTrue(1 <= size < len(atoms))
+
+        for kwargs in ({'block_size': 5}, {'memory_budget': 1e6}):
+            self.assertAlmostEqual(energy(params, p, c, strain),
+                                   energy(params, p, c, strain, **kwargs))
+            self.assertTrue(np.allclose(forces(params, p, c),
+                                        forces(params, p, c, **kwargs)))
+            self.assertTrue(np.allclose(stress(params, p, c, strain),
+                                        stress(params, p, c, strain,
+                                               **kwargs)))
+
+        # The blocked energy can still be differentiated with respect to
+        # params.
+        def f(params, **kwargs):
+            return energy(params, p, c, **kwargs)
+        self.assertAlmostEqual(grad(f)(params)['epsilon'],
+                               grad(f)(params, block_size=5)['epsilon'])
+
+    def test_sparse(self):
+        "Check the sparse pair list path against ase."
+        for struct in ['fcc', 'bcc', 'diamond']:
+            for repeat in [(1, 1, 1),
+                           (1, 2, 3),
+                           (2, 2, 2)]:
+                atoms = bulk('Cu', struct, a=3.7).repeat(repeat)
+                atoms.rattle(0.02)
+                atoms.set_calculator(LennardJones())
+
+                self.assertAlmostEqual(atoms.get_potential_energy(),
+                                       energy_sparse({}, atoms.positions,
+                                                     atoms.cell))
+
+                self.assertTrue(np.allclose(atoms.get_forces(),
+                                            forces_sparse({}, atoms.positions,
+                                                          atoms.cell)))
+
+                self.assertTrue(np.allclose(atoms.get_stress(),
+                                            stress_sparse({}, atoms.positions,
+                                                          atoms.cell)))
+
+    def test_energy_forces_stress(self):
+        "Check the fused evaluation against ase."
+        for struct in ['fcc', 'bcc', 'diamond']:
+            atoms = bulk('Cu', struct, a=3.7).repeat((1, 2, 3))
+            atoms.rattle(0.02)
+            atoms.set_calculator(LennardJones())
+
+            e, f, s = energy_forces_stress({}, atoms.positions, atoms.cell)
+            self.assertAlmostEqual(atoms.get_potential_energy(), e)
+            self.assertTrue(np.allclose(atoms.get_forces(), f))
+            self.assertTrue(np.allclose(atoms.get_stress(), s))
+
+    def test_analytic(self):
+        "Check the analytic backend against autograd."
+        strain = np.array([[0.01, 0.02, 0.0],
+                           [0.0, -0.01, 0.005],
+                           [0.003, 0.0, 0.0]])
+        for struct in ['fcc', 'bcc', 'diamond']:
+            atoms = bulk('Cu', struct, a=3.7).repeat((1, 2, 3))
+            atoms.rattle(0.02)
+            args = ({'sigma': 1.1}, atoms.positions, atoms.cell)
+
+            self.assertTrue(np.allclose(forces(*args),
+                                        forces(*args, backend='analytic')))
+            self.assertTrue(np.allclose(stress(*args),
+                                        stress(*args, backend='analytic')))
+
+            ref = energy_forces_stress(*args, strain)
+            result = energy_forces_stress(*args, strain, backend='analytic')
+            self.assertAlmostEqual(ref[0], result[0])
+            self.assertTrue(np.allclose(ref[1], result[1]))
+            self.assertTrue(np.allclose(ref[2], result[2]))
+
+        with self.assertRaises(ValueError):
+            forces(*args, backend='numba')
+
+    def test_batch(self):
+        "Check the batched energies and their parameter gradients."
+        positions, cells = [], []
+        for struct, repeat in [('fcc', (1, 1, 1)),
+                               ('bcc', (1, 2, 1)),
+                               ('diamond', (1, 1, 2)),
+                               ('hcp', (1, 1, 1))]:
+            atoms = bulk('Cu', struct, a=3.7).repeat(repeat)
+            atoms.rattle(0.02)
+            positions += [atoms.positions]
+            cells += [atoms.cell]
+
+        # an atom outside of the unit cell
+        atoms = bulk('Cu', 'fcc', a=3.7).repeat((2, 1, 1))
+        atoms.positions[0] += 2 * atoms.cell[2]
+        positions += [atoms.positions]
+        cells += [atoms.cell]
+
+        params = {'sigma': 1.1, 'epsilon': 0.9}
+        ref = [energy(params, p, c) for p, c in zip(positions, cells)]
+        self.assertAlmostEqual(ref[-1], energy_sparse(params, positions[-1],
+                                                      np.array(cells[-1])))
+        self.assertTrue(np.allclose(ref, energy_batch(params, positions,
+                                                      cells)))
+
+        def loss(params):
+            return np.sum(np.array([energy(params, p, c)
+                                    for p, c in zip(positions, cells)]))
+
+        def batch_loss(params):
+            return np.sum(energy_batch(params, positions, cells))
+
+        g, bg = grad(loss)(params), grad(batch_loss)(params)
+        for key in params:
+            self.assertAlmostEqual(g[key], bg[key])
+
+
+class TestHessian(unittest.TestCase):
+    def test_hessian(self):
+        "Compare to finite differences of the forces and to the product."
+        slab = fcc111('Cu', (2, 2, 2), a=3.7, vacuum=1.0)
+        for atoms in (bulk('Cu', 'fcc', a=3.7).repeat((2, 2, 2)), slab):
+            atoms.rattle(0.05)
+            params = {'sigma': 1.1, 'epsilon': 0.9}
+            positions = atoms.positions
+            cell = np.array(atoms.cell)
+            natoms = len(atoms)
+
+            H = hessian(params, positions, cell, pbc=atoms.pbc)
+            self.assertEqual(H.shape, (3 * natoms, 3 * natoms))
+            self.assertTrue(np.allclose(H, H.T))
+            # a rigid translation does not change the forces
+            self.assertTrue(np.allclose(
+                H.reshape(3 * natoms, natoms, 3).sum(1), 0.0))
+
+            h = 1e-5
+            columns = []
+            for a in range(natoms):
+                for k in range(3):
+                    dx = np.zeros((natoms, 3))
+                    dx[a, k] = h
+                    fp = forces(params, positions + dx, cell, 'analytic',
+                                pbc=atoms.pbc)
+                    fm = forces(params, positions - dx, cell, 'analytic',
+                                pbc=atoms.pbc)
+                    columns += [-(fp - fm).ravel() / (2 * h)]
+            self.assertTrue(np.allclose(H, np.array(columns).T, atol=1e-6))
+
+            v = np.random.RandomState(42).randn(natoms, 3)
+            Hv = hessian_vector_product(params, positions, cell, v,
+                                        pbc=atoms.pbc)
+            self.assertTrue(np.allclose(Hv.ravel(), np.dot(H, v.ravel())))
+
+
+class TestCalculator(unittest.TestCase):
+    def test_lj(self):
+        "Check the calculator against ase and that it caches the results."
+        from mlp.ag.calculator import LennardJones as AGLennardJones
+
+        atoms = bulk('Cu', 'fcc', a=3.7).repeat((2, 2, 2))
+        atoms.rattle(0.02)
+        ref = atoms.copy()
+        ref.set_calculator(LennardJones(sigma=1.1, epsilon=0.9))
+
+        calc = AGLennardJones(sigma=1.1, epsilon=0.9)
+        ncalls = []
+        calculate = calc.calculate
+
+        def counting_calculate(*args, **kwargs):
+            ncalls.append(1)
+            return calculate(*args, **kwargs)
+
+        calc.calculate = counting_calculate
+        atoms.set_calculator(calc)
+
+        self.assertAlmostEqual(atoms.get_potential_energy(),
+                               ref.get_potential_energy())
+        self.assertTrue(np.allclose(atoms.get_forces(), ref.get_forces()))
+        self.assertTrue(np.allclose(atoms.get_stress(), ref.get_stress()))
+        self.assertEqual(len(ncalls), 1)
+
+        # moving the atoms invalidates the cache
+        atoms.positions[0] += 0.01
+        ref.positions[0] += 0.01
+        self.assertTrue(np.allclose(atoms.get_forces(), ref.get_forces()))
+        self.assertAlmostEqual(atoms.get_potential_energy(),
+                               ref.get_potential_energy())
+        self.assertEqual(len(ncalls), 2)
+
+        # and so does changing the parameters
+        calc.set(sigma=1.0)
+        ref.set_calculator(LennardJones(sigma=1.0, epsilon=0.9))
+        self.assertAlmostEqual(atoms.get_potential_energy(),
+                               ref.get_potential_energy())
+        self.assertEqual(len(ncalls), 3)
+        self.assertEqual(calc.neighborlist.nrebuilds, 1)
+
+    def test_pbc(self):
+        "Check a slab and a cluster against ase."
+        from mlp.ag.calculator import LennardJones as AGLennardJones
+
+        slab = fcc111('Cu', (2, 2, 3), a=3.7, vacuum=1.0)
+        cluster = Icosahedron('Cu', 2, latticeconstant=3.7)
+        cluster.set_cell(np.zeros((3, 3)))
+        refs = []
+        for atoms in (slab, cluster):
+            atoms.rattle(0.02)
+            ref = atoms.copy()
+            ref.set_calculator(LennardJones())
+            atoms.set_calculator(AGLennardJones(backend='analytic'))
+            refs += [ref]
+
+            self.assertAlmostEqual(atoms.get_potential_energy(),
+                                   ref.get_potential_energy())
+            self.assertTrue(np.allclose(atoms.get_forces(),
+                                        ref.get_forces()))
+
+        self.assertTrue(np.allclose(slab.get_stress(), refs[0].get_stress()))
+        with self.assertRaises(PropertyNotImplementedError):
+            cluster.get_stress()
+
+
+class TestDistanceMoments(unittest.TestCase):
+    def test_energies(self):
+        "Check the cached energies and gradients against energy."
+        positions, cells = [], []
+        for struct in ['fcc', 'bcc', 'diamond', 'hcp']:
+            for a in [3.5, 3.7]:
+                atoms = bulk('Cu', struct, a=a).repeat((1, 1, 2))
+                atoms.rattle(0.05)
+                positions += [atoms.positions]
+                cells += [atoms.cell]
+
+        moments = DistanceMoments(positions, cells, sigma_max=1.4)
+        for sigma in [0.8, 1.0, 1.2, 1.4]:
+            params = {'sigma': sigma, 'epsilon': 0.9}
+            ref = [energy(params, p, c) for p, c in zip(positions, cells)]
+            self.assertTrue(np.allclose(ref, moments.energies(params)))
+
+            g = grad(lambda p: np.sum(energy_batch(p, positions, cells)))(
+                params)
+            mg = grad(lambda p: np.sum(moments.energies(p)))(params)
+            for key in params:
+                self.assertAlmostEqual(g[key], mg[key])
+
+        with self.assertRaises(ValueError):
+            moments.energies({'sigma': 1.5})
+
+
+class TestParallelObjective(unittest.TestCase):
+    def test_objective(self):
+        "The parallel objective and gradient match a serial evaluation."
+        from mlp.ag.parallel import ParallelObjective
+
+        positions, cells = [], []
+        for struct in ['fcc', 'bcc', 'diamond', 'hcp', 'sc']:
+            atoms = bulk('Ar', struct, a=4.0)
+            atoms.rattle(0.05)
+            positions += [atoms.positions]
+            cells += [atoms.cell]
+        energies = np.linspace(-0.1, 0.0, len(positions))
+        params = {'sigma': 3.5, 'epsilon': 0.01}
+
+        def objective(params, step=None):
+            errs = energy_batch(params, positions, cells) - energies
+            return np.mean(np.abs(errs))
+
+        with ParallelObjective(positions, cells, energies, nprocs=2) as f:
+            self.assertAlmostEqual(f(params), objective(params))
+            g, ref = f.grad(params), grad(objective)(params)
+            for key in params:
+                self.assertAlmostEqual(g[key], ref[key])
+            # grad at the same params reuses the value from __call__, so it
+            # does not need the workers
+            f.close()
+            self.assertAlmostEqual(f.grad(params)['sigma'], ref['sigma'])
+
+    def test_errors(self):
+        "An exception in a worker is raised in the parent."
+        from mlp.ag.parallel import ParallelObjective
+
+        atoms = bulk('Ar', 'fcc', a=4.0)
+        positions = [atoms.positions, atoms.positions]
+        cells = [atoms.cell, np.zeros((3, 3))]
+        with ParallelObjective(positions, cells, [0.0, 0.0], nprocs=2) as f:
+            with self.assertRaises(np.linalg.LinAlgError):
+                f({'sigma': 3.5, 'epsilon': 0.01})
+            # the workers are still alive
+            with self.assertRaises(np.linalg.LinAlgError):
+                f({'sigma': 3.4, 'epsilon': 0.01})
+
+            # a dead worker is reported, and close does not fail on it
+            f.processes[0].terminate()
+            f.processes[0].join()
+            with self.assertRaises(RuntimeError):
+                f({'sigma': 3.3, 'epsilon': 0.01})
+
+
+class TestFit(unittest.TestCase):
+    def test_train(self):
+        "Mini-batch training recovers known parameters from energy and forces."
+        import os
+        import tempfile
+        from mlp.ag.fit import train, load_params, loss
+
+        true_params = {'sigma': 1.0, 'epsilon': 1.0}
+        positions, cells, energies, all_forces = [], [], [], []
+        for struct in ['fcc', 'bcc', 'diamond']:
+            for a in [1.6, 1.8]:
+                atoms = bulk('Ar', struct, a=a)
+                atoms.rattle(0.05)
+                positions += [atoms.positions]
+                cells += [atoms.cell]
+                energies += [energy(true_params, atoms.positions, atoms.cell)]
+                all_forces += [forces(true_params, atoms.positions,
+                                      atoms.cell)]
+
+        params = {'sigma': 0.95, 'epsilon': 0.9}
+        initial = loss(params, positions, cells, energies, all_forces)
+
+        fd, checkpoint = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        try:
+            fitted, history = train(params, positions, cells, energies,
+                                    all_forces, batch_size=2,
+                                    step_size=0.005, epochs=20,
+                                    loss_goal=initial / 100,
+                                    checkpoint=checkpoint, seed=0)
+            saved = load_params(checkpoint)
+        finally:
+            os.remove(checkpoint)
+
+        self.assertLess(len(history), 20)
+        self.assertLessEqual(history[-1], initial / 100)
+        for key in true_params:
+            self.assertAlmostEqual(saved[key], float(fitted[key]))
+            self.assertAlmostEqual(true_params[key], float(fitted[key]),
+                                   places=1)
+
+
+class TestInstrument(unittest.TestCase):
+    def test_record(self):
+        "Counters and phase timings are recorded only inside record."
+        from mlp.ag import instrument
+
+        atoms = bulk('Cu', 'fcc', a=3.7).repeat((2, 2, 2))
+        self.assertIsNone(instrument.active())
+
+        with instrument.record() as report:
+            d = get_distances(atoms.positions, atoms.cell, 3.0)
+        self.assertIsNone(instrument.active())
+
+        counters = report.as_dict()['counters']
+        self.assertEqual(counters['candidate_pairs'], d.size)
+        self.assertEqual(counters['image_cells'], d.shape[2])
+        self.assertEqual(counters['pairs_in_cutoff'], np.sum(d > 0))
+        self.assertGreater(counters['bytes'], 0)
+        for phase in ['offsets', 'distances', 'masking']:
+            self.assertIn(phase, report.times)
+
+        with instrument.record() as report:
+            forces({}, atoms.positions, atoms.cell)
+            energy_forces_stress({}, atoms.positions, atoms.cell)
+        self.assertEqual(report.calls['gradient'], 2)
+        self.assertIn('pair terms', report.times)
+        self.assertIn('gradient', str(report))
+
+
+class TestIncrementalEnergy(unittest.TestCase):
+    def check(self, params, atoms, ntrials=30):
+        "Random trials match energy differences, accepted or rejected."
+        rng = np.random.RandomState(0)
+        mc = IncrementalEnergy(params, atoms.positions, atoms.cell)
+        positions = atoms.positions.copy()
+        e = energy(params, positions, atoms.cell)
+        self.assertAlmostEqual(mc.energy, e)
+
+        for trial in range(ntrials):
+            kind = ['move', 'insert', 'delete'][trial % 3]
+            if kind == 'move':
+                k = rng.randint(len(positions))
+                new = positions.copy()
+                new[k] += rng.normal(scale=0.3, size=3)
+                dE = mc.trial_move(k, new[k])
+            elif kind == 'insert':
+                x = np.dot(rng.rand(3), atoms.cell)
+                new = np.concatenate([positions, [x]])
+                dE = mc.trial_insert(x)
+            else:
+                k = rng.randint(len(positions))
+                new = positions.copy()
+                new[k] = new[-1]
+                new = new[:-1]
+                dE = mc.trial_delete(k)
+
+            e_new = energy(params, new, atoms.cell)
+            self.assertAlmostEqual(dE, e_new - e)
+
+            if rng.rand() < 0.5:
+                mc.accept()
+                positions, e = new, e_new
+            else:
+                mc.reject()
+            self.assertEqual(len(mc), len(positions))
+            self.assertAlmostEqual(mc.energy, e)
+            self.assertAlmostEqual(np.sum(mc.atom_energies), e)
+
+        with self.assertRaises(RuntimeError):
+            mc.accept()
+
+    def test_bins(self):
+        "A cell with several bins along each axis."
+        atoms = bulk('Ar', 'fcc', a=5.26, cubic=True).repeat((2, 2, 2))
+        atoms.rattle(0.1)
+        self.check({'sigma': 1.2, 'epsilon': 0.0104}, atoms)
+
+    def test_small_cell(self):
+        "A cell smaller than the cutoff radius, with self images."
+        atoms = bulk('Ar', 'fcc', a=5.26).repeat((1, 1, 2))
+        atoms.rattle(0.1)
+        self.check({'sigma': 3.4, 'epsilon': 0.0104}, atoms, ntrials=12)
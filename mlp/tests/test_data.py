@@ -0,0 +1,64 @@
+"""Tests for the dataset module."""
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import ase.db
+
+from mlp.data import write, Dataset
+
+ARGON = os.path.join(os.path.dirname(__file__), '..', '..', 'docs',
+                     'argon.db')
+
+
+class TestDataset(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db = ase.db.connect(ARGON)
+        write(ARGON, self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_roundtrip(self):
+        "All the structures are stored as in the database."
+        dataset = Dataset(self.directory)
+        rows = list(self.db.select())
+        self.assertEqual(len(dataset), len(rows))
+        self.assertCountEqual(dataset.keys, ['f', 'i', 'structure'])
+
+        self.assertTrue(np.allclose(dataset.energies,
+                                    [row.energy for row in rows]))
+        for k, row in enumerate(rows):
+            structure = dataset[k]
+            self.assertTrue(np.allclose(structure['positions'],
+                                        row.positions))
+            self.assertTrue(np.allclose(structure['forces'], row.forces))
+            self.assertTrue(np.allclose(structure['cell'], row.cell))
+            self.assertEqual(structure['structure'], row.structure)
+            self.assertEqual(structure['f'], row.f)
+
+        atoms = dataset.toatoms(3)
+        self.assertTrue(np.allclose(atoms.positions, rows[3].positions))
+
+    def test_select(self):
+        "Filtered views match the database and do not copy."
+        dataset = Dataset(self.directory)
+        fcc = dataset.select(structure='fcc')
+        rows = list(self.db.select(structure='fcc'))
+        self.assertEqual(len(fcc), len(rows))
+        self.assertTrue(np.allclose(fcc.energies,
+                                    [row.energy for row in rows]))
+
+        view = fcc.select(f=1.0)
+        self.assertEqual(len(view),
+                         len(list(self.db.select(structure='fcc', f=1.0))))
+        self.assertTrue(np.all(view.get('structure') == 'fcc'))
+
+        positions = fcc.positions[0]
+        self.assertTrue(np.shares_memory(positions,
+                                         dataset._arrays['positions']))
+        self.assertIsInstance(positions.base, np.memmap)
+
+        self.assertEqual(len(dataset[10:20]), 10)
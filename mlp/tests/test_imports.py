@@ -0,0 +1,58 @@
+"""Import time regression tests.
+
+The imports run in a fresh interpreter, so modules already imported by other
+tests do not hide a slow or heavy import.
+"""
+import os
+import subprocess
+import sys
+import unittest
+
+import mlp
+from mlp.backends import require
+
+# seconds allowed for importing mlp.ag.lennardjones, which is mostly autograd
+IMPORT_BUDGET = 2.0
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(mlp.__file__)))
+
+
+def run_import(module):
+    """Import module in a new interpreter.
+
+    Returns the import time and the set of top-level modules that were loaded.
+    """
+    code = ('import sys, time\n'
+            't0 = time.perf_counter()\n'
+            'import {}\n'
+            'print(time.perf_counter() - t0)\n'
+            'print(" ".join(sorted(set(m.split(".")[0] '
+            'for m in sys.modules))))\n').format(module)
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([ROOT, env.get('PYTHONPATH', '')])
+    out = subprocess.check_output([sys.executable, '-c', code], cwd=ROOT,
+                                  env=env, universal_newlines=True)
+    seconds, modules = out.strip().split('\n')[-2:]
+    return float(seconds), set(modules.split())
+
+
+class TestImports(unittest.TestCase):
+    def test_lennardjones(self):
+        seconds, modules = run_import('mlp.ag.lennardjones')
+        self.assertNotIn('tensorflow', modules)
+        self.assertNotIn('ase', modules)
+        self.assertLess(seconds, IMPORT_BUDGET)
+
+    def test_sanity(self):
+        seconds, modules = run_import('mlp.sanity')
+        self.assertNotIn('tensorflow', modules)
+        self.assertNotIn('ase', modules)
+
+    def test_data(self):
+        seconds, modules = run_import('mlp.data')
+        self.assertNotIn('ase', modules)
+
+    def test_require(self):
+        self.assertEqual(require('ase.db').__name__, 'ase.db')
+        with self.assertRaises(ImportError):
+            require('not_a_real_module')
@@ -2,10 +2,23 @@
 import itertools
 import numpy as np
 import tensorflow as tf
-
+from ase.build import bulk
+from ase.calculators.lj import LennardJones
+
+from mlp.ag.neighborlist import get_distances as ag_get_distances
+from mlp.ag.neighborlist import get_neighbors_oneway as ag_get_neighbors_oneway
+from mlp.ag.lennardjones import energy as ag_energy
+from mlp.ag.lennardjones import forces as ag_forces
+from mlp.ag.lennardjones import stress as ag_stress
+from mlp.tf.neighborlist import (get_distances, get_neighbors_oneway,
+                                 get_offsets)
+from mlp.tf.lennardjones import energy as lj_energy
+from mlp.tf.lennardjones import stress as lj_stress
+from mlp.tf.lennardjones import (energy_forces_stress as
+                                 lj_energy_forces_stress)
 from mlp.tf.utils import (tri, triu_indices, tril_indices,
                           triu_indices_from, tril_indices_from,
-                          combinations)
+                          combinations, _triu_indices)
 
 
 class TestTFUtils_tri(tf.test.TestCase):
@@ -83,6 +96,31 @@ class TestTFUtils_triu(tf.test.TestCase):
             self.assertTrue(np.all(npu[0] == r0.eval()))
             self.assertTrue(np.all(npu[1] == r1.eval()))
 
+    def test_triu_larger(self):
+        for n, m, k in [(7, 7, 0), (7, 9, 2), (9, 4, -3), (5, 5, 6),
+                        (5, 5, -6)]:
+            npu = np.triu_indices(n, k=k, m=m)
+            r0, r1 = triu_indices(n, k=k, m=m)
+            with self.test_session():
+                self.assertAllEqual(npu[0], r0.eval())
+                self.assertAllEqual(npu[1], r1.eval())
+
+    def test_triu_cached(self):
+        _triu_indices.cache_clear()
+        triu_indices(11, k=1)
+        triu_indices(11, k=1)
+        info = _triu_indices.cache_info()
+        self.assertEqual((info.hits, info.misses), (1, 1))
+
+    def test_triu_tensor(self):
+        "A size known only at run time uses the graph version."
+        npu = np.triu_indices(4, k=1)
+        with self.test_session() as sess:
+            n = tf.compat.v1.placeholder(tf.int32, shape=[])
+            r0, r1 = sess.run(triu_indices(n, k=1), {n: 4})
+            self.assertAllEqual(npu[0], r0)
+            self.assertAllEqual(npu[1], r1)
+
 
 class TestTFUtils_tril(tf.test.TestCase):
     def test_tril(self):
@@ -120,6 +158,15 @@ class TestTFUtils_tril(tf.test.TestCase):
             self.assertTrue(np.all(npu[0] == r0.eval()))
             self.assertTrue(np.all(npu[1] == r1.eval()))
 
+    def test_tril_larger(self):
+        for n, m, k in [(7, 7, 0), (7, 9, 2), (9, 4, -3), (5, 5, 6),
+                        (5, 5, -6)]:
+            npu = np.tril_indices(n, k=k, m=m)
+            r0, r1 = tril_indices(n, k=k, m=m)
+            with self.test_session():
+                self.assertAllEqual(npu[0], r0.eval())
+                self.assertAllEqual(npu[1], r1.eval())
+
 
 class TestTFUtils_triu_indices_from(tf.test.TestCase):
     def test_triu_indices_from(self):
@@ -209,3 +256,195 @@ class TestTFUtils_combinations(tf.test.TestCase):
         with self.assertRaises(ValueError):
             with self.test_session():
                 tf_combs = combinations(a, 2).eval()
+
+    def test_combinations_dynamic(self):
+        a = np.arange(7) * 10
+        for k in [1, 2, 3]:
+            combs = np.array(list(itertools.combinations(a, k)))
+            with self.test_session() as sess:
+                x = tf.compat.v1.placeholder(tf.int64, shape=[None])
+                tf_combs = sess.run(combinations(x, k), {x: a})
+                self.assertAllEqual(combs, tf_combs)
+
+    def test_combinations_graph_size(self):
+        "The graph does not grow with the number of combinations."
+        a = np.arange(40)
+        graph = tf.Graph()
+        with graph.as_default():
+            c = combinations(a, 3)
+            self.assertLess(len(graph.get_operations()), 10)
+            with self.session(graph=graph):
+                self.assertAllEqual(
+                    c.eval(), np.array(list(itertools.combinations(a, 3))))
+
+
+class TestTFNeighborList(tf.test.TestCase):
+    def setUp(self):
+        atoms = bulk('Cu', 'fcc', a=3.6).repeat((2, 1, 2))
+        atoms.rattle(0.1, seed=1)
+        self.atoms = atoms
+        # the same atoms, with one outside of the unit cell
+        self.positions = atoms.positions.copy()
+        self.positions[0] -= atoms.cell[0]
+        self.strain = np.array([[0.01, 0.002, 0.0],
+                                [0.002, -0.01, 0.003],
+                                [0.0, 0.003, 0.005]])
+
+    def sorted_distances(self, d):
+        "The nonzero distances of each atom, sorted."
+        return [np.sort(row[row > 0]) for row in d.reshape(len(d), -1)]
+
+    def test_distances(self):
+        atoms = self.atoms
+        for strain in (np.zeros((3, 3)), self.strain):
+            ref = ag_get_distances(atoms.positions, atoms.cell, 6.0,
+                                   strain=strain)
+            d = get_distances(self.positions, atoms.cell, 6.0, strain=strain)
+            with self.test_session():
+                d = d.eval()
+            for r1, r2 in zip(self.sorted_distances(ref),
+                              self.sorted_distances(d)):
+                self.assertAllClose(r1, r2)
+
+    def test_oneway(self):
+        atoms = self.atoms
+        for strain in (np.zeros((3, 3)), self.strain):
+            neighbors, displacements = ag_get_neighbors_oneway(
+                self.positions, atoms.cell, 6.0, strain=strain)
+            ref = set((a, i) + tuple(n)
+                      for a in range(len(atoms))
+                      for i, n in zip(neighbors[a], displacements[a]))
+
+            pairs, offsets = get_neighbors_oneway(self.positions, atoms.cell,
+                                                  6.0, strain=strain)
+            with self.test_session():
+                pairs, offsets = pairs.eval(), offsets.eval()
+            found = [tuple(p) + tuple(n) for p, n in zip(pairs, offsets)]
+            self.assertEqual(len(found), len(ref))
+            self.assertEqual(set(found), ref)
+
+            d = get_distances(self.positions, atoms.cell, 6.0, skin=0.0,
+                              strain=strain, oneway=True)
+            with self.test_session():
+                self.assertEqual(np.sum(d.eval() > 0), len(ref))
+
+    def test_batch(self):
+        "A padded batch gives the same distances as each configuration."
+        small = bulk('Ar', 'fcc', a=5.26)
+        small.rattle(0.05, seed=2)
+        configurations = [self.atoms, small]
+        maxatoms = len(self.atoms)
+        positions = np.zeros((2, maxatoms, 3))
+        for b, atoms in enumerate(configurations):
+            positions[b, :len(atoms)] = atoms.positions
+        cells = np.array([atoms.cell for atoms in configurations])
+        natoms = [len(atoms) for atoms in configurations]
+
+        d = get_distances(positions, cells, 6.0, natoms=natoms)
+        with self.test_session():
+            d = d.eval()
+        self.assertTrue(np.all(d[1, natoms[1]:] == 0))
+        self.assertTrue(np.all(d[1, :, natoms[1]:] == 0))
+        for b, atoms in enumerate(configurations):
+            ref = ag_get_distances(atoms.positions, atoms.cell, 6.0)
+            n = natoms[b]
+            for r1, r2 in zip(self.sorted_distances(ref),
+                              self.sorted_distances(d[b, :n, :n])):
+                self.assertAllClose(r1, r2)
+
+    def test_xla(self):
+        "Static offsets compile with XLA, and gradients go through."
+        atoms = self.atoms
+        offsets = get_offsets(atoms.cell, 6.0, strain=self.strain)
+
+        @tf.function(jit_compile=True)
+        def f(positions, strain):
+            d = get_distances(positions, atoms.cell, 6.0, strain=strain,
+                              offsets=offsets)
+            e = tf.reduce_sum(tf.where(d > 0, d**-6, tf.zeros_like(d)))
+            return e, tf.gradients(e, [positions, strain])
+
+        e, (dedr, deds) = f(tf.constant(atoms.positions),
+                            tf.constant(self.strain))
+        ref = get_distances(atoms.positions, atoms.cell, 6.0,
+                            strain=self.strain)
+        with self.test_session():
+            e, dedr, deds, ref = e.eval(), dedr.eval(), deds.eval(), ref.eval()
+        self.assertAllClose(e, np.sum(ref[ref > 0]**-6))
+        self.assertEqual(dedr.shape, (len(atoms), 3))
+        self.assertAllClose(np.sum(dedr, axis=0), np.zeros(3))
+        self.assertTrue(np.all(np.isfinite(deds)))
+
+
+class TestTFLennardJones(tf.test.TestCase):
+    def test_fcc(self):
+        "Check structures with different symmetries against ase."
+        for struct in ['fcc', 'bcc', 'diamond']:
+            for repeat in [(1, 1, 1), (1, 2, 3)]:
+                atoms = bulk('Cu', struct, a=3.7).repeat(repeat)
+                atoms.rattle(0.02, seed=3)
+                atoms.set_calculator(LennardJones())
+
+                e, f, s = lj_energy_forces_stress({}, atoms.positions,
+                                                  atoms.cell)
+                with self.test_session():
+                    e, f, s = e.eval(), f.eval(), s.eval()
+                self.assertAlmostEqual(atoms.get_potential_energy(), e)
+                self.assertAllClose(atoms.get_forces(), f)
+                self.assertAllClose(atoms.get_stress(), s)
+
+    def test_strain(self):
+        "The strained energy and stress match the autograd version."
+        atoms = bulk('Ar', 'fcc', a=5.26).repeat((2, 1, 1))
+        atoms.rattle(0.05, seed=4)
+        params = {'sigma': 3.4, 'epsilon': 0.0104}
+        strain = np.array([[0.01, 0.002, 0.0],
+                           [0.002, -0.01, 0.003],
+                           [0.0, 0.003, 0.005]])
+
+        e = lj_energy(params, atoms.positions, atoms.cell, strain)
+        s = lj_stress(params, atoms.positions, atoms.cell, strain)
+        with self.test_session():
+            e, s = e.eval(), s.eval()
+        self.assertAlmostEqual(e, ag_energy(params, atoms.positions,
+                                            atoms.cell, strain))
+        self.assertAllClose(s, ag_stress(params, atoms.positions, atoms.cell,
+                                         strain))
+
+    def test_batch(self):
+        "A padded batch matches each configuration, and params get gradients."
+        configurations = []
+        for struct, repeat in [('fcc', (2, 1, 1)), ('bcc', (1, 1, 1))]:
+            atoms = bulk('Ar', struct, a=5.26).repeat(repeat)
+            atoms.rattle(0.05, seed=5)
+            configurations += [atoms]
+        natoms = [len(atoms) for atoms in configurations]
+        positions = np.zeros((2, max(natoms), 3))
+        for b, atoms in enumerate(configurations):
+            positions[b, :natoms[b]] = atoms.positions
+        cells = np.array([atoms.cell for atoms in configurations])
+
+        params = {'sigma': tf.Variable(3.4, dtype=tf.float64),
+                  'epsilon': tf.Variable(0.0104, dtype=tf.float64)}
+        offsets = get_offsets(cells, 3 * 3.4)
+        with tf.GradientTape() as tape:
+            e, f, s = lj_energy_forces_stress(params, positions, cells,
+                                              offsets=offsets, natoms=natoms)
+            loss = tf.reduce_sum(e)
+        dloss = tape.gradient(loss, params['epsilon'])
+
+        with self.test_session() as sess:
+            sess.run(tf.compat.v1.global_variables_initializer())
+            e, f, s, loss, dloss = sess.run([e, f, s, loss, dloss])
+
+        fp = {'sigma': 3.4, 'epsilon': 0.0104}
+        for b, atoms in enumerate(configurations):
+            self.assertAlmostEqual(e[b], ag_energy(fp, atoms.positions,
+                                                   atoms.cell))
+            self.assertAllClose(f[b, :natoms[b]],
+                                ag_forces(fp, atoms.positions, atoms.cell))
+            self.assertAllClose(s[b], ag_stress(fp, atoms.positions,
+                                                atoms.cell))
+        self.assertAllEqual(f[1, natoms[1]:], np.zeros((1, 3)))
+        # the energy is linear in epsilon
+        self.assertAlmostEqual(dloss, loss / 0.0104)
@@ -0,0 +1,150 @@
+"""A periodic Lennard Jones potential in Tensorflow.
+
+This follows `mlp.ag.lennardjones`: the cutoff radius is 3 * sigma, the pair
+energy is shifted to zero at the cutoff, and the stress is returned as
+[sxx, syy, szz, syz, sxz, sxy].
+
+Every function takes a single configuration or a padded batch, see
+`mlp.tf.neighborlist`, and the forces and stress come from one
+tf.GradientTape over the batch energies. The params can be floats or tensors,
+e.g. tf.Variables to fit.
+
+"""
+import tensorflow as tf
+from mlp.tf.neighborlist import get_distances
+
+
+def _batch(positions, cell, strain):
+    """Convert the arguments to batched tensors.
+
+    Returns positions, cells, strains and whether the input was batched.
+    """
+    positions = tf.convert_to_tensor(positions, dtype=tf.float64)
+    cell = tf.convert_to_tensor(cell, dtype=tf.float64)
+    batched = positions.get_shape().ndims == 3
+    if not batched:
+        positions = positions[None]
+        cell = cell[None]
+
+    if strain is None:
+        strain = tf.zeros_like(cell)
+    else:
+        strain = tf.convert_to_tensor(strain, dtype=tf.float64)
+        if strain.get_shape().ndims == 2:
+            strain = tf.tile(strain[None], [tf.shape(cell)[0], 1, 1])
+    return positions, cell, strain, batched
+
+
+def _energy(params, positions, cell, strain, offsets, natoms):
+    """The energies of a batch of configurations. Shape = (nbatch,)"""
+    sigma = tf.convert_to_tensor(params.get('sigma', 1.0), dtype=tf.float64)
+    epsilon = tf.convert_to_tensor(params.get('epsilon', 1.0),
+                                   dtype=tf.float64)
+
+    rc = 3 * sigma
+
+    e0 = 4 * epsilon * ((sigma / rc)**12 - (sigma / rc)**6)
+
+    r2 = get_distances(positions, cell, rc, 0.01, strain, offsets, natoms)**2
+
+    inside = (r2 <= rc**2) & (r2 > 0.0)
+    adjusted = tf.where(inside, r2, tf.ones_like(r2))
+
+    c6 = tf.where(inside, (sigma**2 / adjusted)**3, tf.zeros_like(r2))
+    c12 = c6**2
+    pair_energies = tf.where(inside, 4 * epsilon * (c12 - c6) - e0,
+                             tf.zeros_like(r2))
+
+    # get_distances double counts the interactions, so we divide by two.
+    return tf.reduce_sum(pair_energies, axis=[1, 2, 3]) / 2
+
+
+def energy(params, positions, cell, strain=None, offsets=None, natoms=None):
+    """Compute the energy of a Lennard-Jones system.
+
+    Parameters
+    ----------
+
+    params : dictionary of paramters.
+      Defaults to {'sigma': 1.0, 'epsilon': 1.0}
+
+    positions : Shape = (natoms, 3), or (nbatch, maxatoms, 3) for a batch.
+
+    cell: unit cell vectors. Shape = (3, 3) or (nbatch, 3, 3)
+
+    strain: strains to apply to the cells. Shape = (3, 3) or (nbatch, 3, 3)
+
+    offsets: integer cell offsets from `mlp.tf.neighborlist.get_offsets`.
+      Pass them to get static shapes for XLA. They must cover a cutoff radius
+      of 3 * sigma.
+
+    natoms: the number of real atoms in each padded configuration.
+      Shape = (nbatch,). Defaults to all atoms.
+
+    Returns
+    -------
+    energy : a scalar tensor, or shape (nbatch,) for a batch.
+    """
+    positions, cell, strain, batched = _batch(positions, cell, strain)
+    energies = _energy(params, positions, cell, strain, offsets, natoms)
+    return energies if batched else energies[0]
+
+
+def energy_forces_stress(params, positions, cell, strain=None, offsets=None,
+                         natoms=None):
+    """Compute the energy, forces and stress with one gradient tape.
+
+    The arguments are the same as for `energy`.
+
+    Returns
+    -------
+    energy, forces, stress : tensors with shapes (), (natoms, 3) and (6,), or
+    (nbatch,), (nbatch, maxatoms, 3) and (nbatch, 6) for a batch. The forces
+    on padding atoms are zero. The stress is [sxx, syy, szz, syz, sxz, sxy].
+    """
+    positions, cell, strain, batched = _batch(positions, cell, strain)
+
+    with tf.GradientTape() as tape:
+        tape.watch(positions)
+        tape.watch(strain)
+        energies = _energy(params, positions, cell, strain, offsets, natoms)
+    # The configurations are independent, so the gradients of the total
+    # energy are the gradients of each configuration.
+    dEdR, dEdst = tape.gradient(energies, [positions, strain])
+
+    volume = tf.abs(tf.linalg.det(cell))
+    stress = (dEdst + tf.linalg.matrix_transpose(dEdst)) / 2
+    stress = stress / volume[:, None, None]
+    stress = tf.gather(tf.reshape(stress, [-1, 9]), [0, 4, 8, 5, 2, 1],
+                       axis=1)
+
+    if not batched:
+        return energies[0], -dEdR[0], stress[0]
+    return energies, -dEdR, stress
+
+
+def forces(params, positions, cell, offsets=None, natoms=None):
+    """Compute the forces of a Lennard-Jones system.
+
+    The arguments are the same as for `energy`.
+
+    Returns
+    -------
+    forces : Shape = (natoms, 3), or (nbatch, maxatoms, 3) for a batch.
+    """
+    return energy_forces_stress(params, positions, cell, offsets=offsets,
+                                natoms=natoms)[1]
+
+
+def stress(params, positions, cell, strain=None, offsets=None, natoms=None):
+    """Compute the stress on a Lennard-Jones system.
+
+    The arguments are the same as for `energy`.
+
+    Returns
+    -------
+    stress : Shape = (6,), or (nbatch, 6) for a batch.
+      [sxx, syy, szz, syz, sxz, sxy]
+    """
+    return energy_forces_stress(params, positions, cell, strain, offsets,
+                                natoms)[2]
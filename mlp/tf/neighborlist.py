@@ -0,0 +1,226 @@
+"""A periodic neighborlist in Tensorflow.
+
+These are ports of `mlp.ag.neighborlist.get_distances` and
+`get_neighbors_oneway` that stay in the graph, so the neighbor search, an
+energy and its gradients can be one compiled function.
+
+All functions take a single configuration, with positions of shape (natoms, 3)
+and a (3, 3) cell, or a batch of them with shapes (nbatch, maxatoms, 3) and
+(nbatch, 3, 3). Shorter configurations in a batch are padded at the end and
+their lengths are given with natoms.
+
+The number of periodic images depends on the cell, so by default the cell
+offsets are computed in the graph and have a dynamic shape. XLA needs static
+shapes, so for `tf.function(jit_compile=True)` compute the offsets once with
+`get_offsets` and pass them in.
+
+"""
+import itertools
+import numpy as np
+import tensorflow as tf
+
+
+def get_offsets(cells, cutoff_radius, skin=0.01, strain=None):
+    """Return the integer cell offsets needed to find all neighbors.
+
+    This runs in numpy, outside the graph.
+
+    Parameters
+    ----------
+
+    cells: unit cells. array-like (3, 3) or (nbatch, 3, 3)
+    cutoff_radius: Maximum radius to get neighbor distances for. float
+    skin: A tolerance for the cutoff_radius. float
+    strain: array-like (3, 3) or (nbatch, 3, 3), optional. The offsets are
+    for the strained cells.
+
+    Returns
+    -------
+
+    offsets : an integer array of shape (noffsets, 3). They cover every
+    configuration in the batch, for atoms wrapped into the unit cell.
+
+    """
+    cells = np.asarray(cells, dtype=float).reshape(-1, 3, 3)
+    if strain is not None:
+        strain_tensor = np.eye(3) + np.asarray(strain, dtype=float)
+        cells = np.matmul(cells, np.swapaxes(strain_tensor, -1, -2))
+    num_repeats = ((cutoff_radius + skin) *
+                   np.linalg.norm(np.linalg.inv(cells), axis=1))
+    nmax = np.ceil(np.max(num_repeats, axis=0)).astype(int)
+    return np.array(list(itertools.product(
+        *[np.arange(-n, n + 1) for n in nmax])), dtype=int)
+
+
+def _prepare(positions, cell, strain, natoms):
+    """Convert the arguments to batched tensors.
+
+    Returns positions, cells, atom mask and whether the input was batched.
+    """
+    positions = tf.convert_to_tensor(positions, dtype=tf.float64)
+    cell = tf.convert_to_tensor(cell, dtype=tf.float64)
+
+    batched = positions.get_shape().ndims == 3
+    if not batched:
+        positions = positions[None]
+        cell = cell[None]
+
+    if strain is not None:
+        strain = tf.convert_to_tensor(strain, dtype=tf.float64)
+        strain_tensor = tf.eye(3, dtype=tf.float64) + strain
+        if strain.get_shape().ndims == 2:
+            strain_tensor = strain_tensor[None]
+        cell = tf.matmul(cell, strain_tensor, transpose_b=True)
+        positions = tf.matmul(positions, strain_tensor, transpose_b=True)
+
+    maxatoms = tf.shape(positions)[1]
+    if natoms is None:
+        mask = tf.ones(tf.shape(positions)[:2], dtype=tf.bool)
+    else:
+        if not batched:
+            natoms = tf.reshape(natoms, [1])
+        mask = tf.sequence_mask(natoms, maxatoms)
+
+    return positions, cell, mask, batched
+
+
+def _offsets(cell, cutoff_radius):
+    """The cell offsets for a batch of cells, computed in the graph."""
+    num_repeats = cutoff_radius * tf.norm(tf.linalg.inv(cell), axis=1)
+    nmax = tf.cast(tf.math.ceil(tf.reduce_max(num_repeats, axis=0)),
+                   tf.int32)
+    ranges = [tf.range(-nmax[k], nmax[k] + 1) for k in range(3)]
+    grid = tf.meshgrid(*ranges, indexing='ij')
+    return tf.reshape(tf.stack(grid, axis=-1), [-1, 3])
+
+
+def _wrap(positions, cell):
+    """Wrap positions into the unit cell.
+
+    Returns the wrapped positions and the integer cell each atom was moved out
+    of. The wrap is a constant shift, so gradients pass through unchanged.
+    """
+    fractional_coords = tf.matmul(positions, tf.linalg.inv(cell))
+    wraps = tf.stop_gradient(tf.floor(fractional_coords))
+    return positions - tf.matmul(wraps, cell), wraps
+
+
+def _oneway(offsets, maxatoms):
+    """Mask of shape (maxatoms, maxatoms, noffsets) that keeps each pair once.
+
+    Only offsets in one half-space are used, and in the home cell only the
+    pairs (a, i) with i > a. This is the rule of `get_neighbors_oneway`.
+    """
+    n1, n2, n3 = offsets[:, 0], offsets[:, 1], offsets[:, 2]
+    z1, z2, z3 = tf.equal(n1, 0), tf.equal(n2, 0), tf.equal(n3, 0)
+    positive = (n1 > 0) | (z1 & (n2 > 0)) | (z1 & z2 & (n3 > 0))
+    home = z1 & z2 & z3
+    r = tf.range(maxatoms)
+    upper = r[None, :] > r[:, None]
+    return (positive[None, None, :] |
+            (home[None, None, :] & upper[:, :, None]))
+
+
+def _distances(positions, cell, cutoff_radius, skin, strain, offsets,
+               natoms, oneway):
+    """Distances and the masks and offsets they were computed with."""
+    positions, cell, mask, batched = _prepare(positions, cell, strain, natoms)
+    positions, wraps = _wrap(positions, cell)
+
+    if offsets is None:
+        offsets = _offsets(cell, cutoff_radius + skin)
+    else:
+        offsets = tf.convert_to_tensor(offsets, dtype=tf.int32)
+
+    # (batch, offset_index, 3)
+    cart_offsets = tf.einsum('ki,bij->bkj', tf.cast(offsets, tf.float64),
+                             cell)
+
+    # (batch, atom_i, atom_j, offset, 3)
+    pv = (positions[:, None, :, None] + cart_offsets[:, None, None] -
+          positions[:, :, None, None])
+
+    d2 = tf.reduce_sum(pv**2, axis=4)
+
+    # The gradient of sqrt is nan at r=0, so we do this round about way to
+    # avoid that.
+    zeros = tf.equal(d2, 0.0)
+    adjusted = tf.where(zeros, tf.ones_like(d2), d2)
+    d = tf.where(zeros, tf.zeros_like(d2), tf.sqrt(adjusted))
+
+    pair_mask = (mask[:, :, None] & mask[:, None, :])[..., None]
+    if oneway:
+        pair_mask &= _oneway(offsets, tf.shape(positions)[1])[None]
+
+    return d, pair_mask, offsets, wraps, batched
+
+
+def get_distances(positions, cell, cutoff_radius, skin=0.01, strain=None,
+                  offsets=None, natoms=None, oneway=False):
+    """Get distances to atoms in a periodic unitcell.
+
+    Parameters
+    ----------
+
+    positions: atomic positions. (natoms, 3) or (nbatch, maxatoms, 3)
+    cell: unit cell. (3, 3) or (nbatch, 3, 3)
+    cutoff_radius: Maximum radius to get neighbor distances for. float
+    skin: A tolerance for the cutoff_radius. float
+    strain: (3, 3) or (nbatch, 3, 3), optional
+    offsets: integer cell offsets (noffsets, 3) from `get_offsets`, optional.
+    They are computed in the graph if they are not given.
+    natoms: The number of real atoms in each configuration, optional.
+    oneway: If True, each pair is only kept once, as in
+    `get_neighbors_oneway`.
+
+    Returns
+    -------
+
+    distances : a tensor of shape (natoms, natoms, noffsets), or (nbatch,
+    maxatoms, maxatoms, noffsets) for a batch. Entry [i, j, k] is the distance
+    from atom i to atom j in the cell at offsets[k], after the atoms are
+    wrapped into the unit cell. Entries outside the cutoff radius, or
+    involving a padding atom, are zeroed.
+
+    """
+    d, pair_mask, _, _, batched = _distances(positions, cell, cutoff_radius,
+                                             skin, strain, offsets, natoms,
+                                             oneway)
+    result = tf.where(pair_mask & (d <= cutoff_radius + skin), d,
+                      tf.zeros_like(d))
+    return result if batched else result[0]
+
+
+def get_neighbors_oneway(positions, cell, cutoff_radius, skin=0.01,
+                         strain=None, offsets=None, natoms=None):
+    """A one-way neighbor list.
+
+    This has the same arguments as `get_distances`. The number of pairs is only
+    known at run time, so use the dense `get_distances(..., oneway=True)`
+    under XLA instead.
+
+    Returns
+    -------
+    pairs, offsets
+
+    pairs is an integer tensor of shape (npairs, 2) with the atoms (a, i) of
+    each pair, or (npairs, 3) with (batch, a, i) for a batch. offsets has shape
+    (npairs, 3), and the vector from atom a to its neighbor is
+    positions[i] + offsets.dot(cell) - positions[a]. Like in
+    `get_neighbors_oneway` the offsets are for the positions that were passed
+    in, and the pairs closer than cutoff_radius are returned.
+
+    """
+    d, pair_mask, offsets, wraps, batched = _distances(
+        positions, cell, cutoff_radius, skin, strain, offsets, natoms, True)
+
+    found = tf.where(pair_mask & (d < cutoff_radius))
+    b, a, i, k = found[:, 0], found[:, 1], found[:, 2], found[:, 3]
+
+    wraps = tf.cast(wraps, tf.int64)
+    n = (tf.gather(tf.cast(offsets, tf.int64), k) -
+         tf.gather_nd(wraps, tf.stack([b, i], axis=1)) +
+         tf.gather_nd(wraps, tf.stack([b, a], axis=1)))
+
+    pairs = found[:, :3] if batched else found[:, 1:3]
+    return pairs, n
@@ -4,7 +4,8 @@ These are mostly functions that bring additional numpy functionality to
 Tensorflow.
 
 """
-import itertools
+import functools
+import numbers
 import numpy as np
 import tensorflow as tf
 
@@ -39,6 +40,42 @@ def tri(N, M=None, k=0, dtype=tf.float64):
     return tf.greater_equal(r1[:, None], r2[None, :])
 
 
+def _static(n, k, m):
+    """True if n, k and m are integers, i.e. not tensors. m may be None."""
+    return (isinstance(n, numbers.Integral) and
+            isinstance(k, numbers.Integral) and
+            (m is None or isinstance(m, numbers.Integral)))
+
+
+def _ranges(starts, stops):
+    """Row and column indices of the ranges starts[r]:stops[r] of each row.
+
+    The work is proportional to the number of indices.
+    """
+    counts = np.maximum(stops - starts, 0)
+    rows = np.repeat(np.arange(len(counts)), counts)
+    # position of each index within its row
+    first = np.cumsum(counts) - counts
+    cols = np.arange(counts.sum()) - first[rows] + starts[rows]
+    rows.flags.writeable = False
+    cols.flags.writeable = False
+    return rows, cols
+
+
+@functools.lru_cache(maxsize=128)
+def _triu_indices(n, k, m):
+    """numpy triu indices as int64 arrays, cached by (n, k, m)."""
+    r = np.arange(n, dtype=np.int64)
+    return _ranges(np.clip(r + k, 0, m), np.full(n, m, dtype=np.int64))
+
+
+@functools.lru_cache(maxsize=128)
+def _tril_indices(n, k, m):
+    """numpy tril indices as int64 arrays, cached by (n, k, m)."""
+    r = np.arange(n, dtype=np.int64)
+    return _ranges(np.zeros(n, dtype=np.int64), np.clip(r + k + 1, 0, m))
+
+
 def triu_indices(n, k=0, m=None):
     """Return indices for upper triangle of an (n, m) array.
 
@@ -59,8 +96,15 @@ def triu_indices(n, k=0, m=None):
       column 0 is one set of indices, column 1 is the other set.
 
     modeled after pydoc:numpy.triu_indices.
+
+    When n, k and m are integers the indices are computed directly and cached,
+    otherwise they are found with a mask in the graph.
     """
 
+    if _static(n, k, m):
+        rows, cols = _triu_indices(n, k, n if m is None else m)
+        return tf.constant(rows), tf.constant(cols)
+
     result = tf.where(tf.logical_not(tri(n, m, k=k - 1)))
     return result[:, 0], result[:, 1]
 
@@ -102,8 +146,15 @@ def tril_indices(n, k=0, m=None):
       column 0 is one set of indices, column 1 is the other set.
 
     modeled after pydoc:numpy.tril_indices.
+
+    When n, k and m are integers the indices are computed directly and cached,
+    otherwise they are found with a mask in the graph.
     """
 
+    if _static(n, k, m):
+        rows, cols = _tril_indices(n, k, n if m is None else m)
+        return tf.constant(rows), tf.constant(cols)
+
     result = tf.where(tri(n, m, k=k))
     return result[:, 0], result[:, 1]
 
@@ -125,12 +176,41 @@ def tril_indices_from(arr, k=0):
     return tril_indices(shape[-2], k=k, m=shape[-1])
 
 
+def _combination_indices(n, k):
+    """Return the integer array of the k-combinations of range(n).
+
+    The combinations are in lexicographic order, like itertools.combinations.
+    Each step extends every combination with each index larger than its last
+    one, so the work is proportional to the size of the output.
+    """
+    combos = np.zeros((1, 0), dtype=np.int64)
+    last = np.array([-1])
+    for _ in range(k):
+        rows, cols = np.nonzero(np.arange(n)[None, :] > last[:, None])
+        combos = np.concatenate([combos[rows], cols[:, None]], axis=1)
+        last = cols
+    return combos
+
+
+def _combination_indices_tf(n, k):
+    """A graph version of `_combination_indices` for an n known at run time."""
+    combos = tf.zeros((1, 0), dtype=tf.int64)
+    last = tf.constant([-1], dtype=tf.int64)
+    r = tf.range(tf.cast(n, tf.int64))
+    for _ in range(k):
+        inds = tf.where(r[None, :] > last[:, None])
+        rows, cols = inds[:, 0], inds[:, 1]
+        combos = tf.concat([tf.gather(combos, rows), cols[:, None]], axis=1)
+        last = cols
+    return combos
+
+
 def combinations(arr, k):
     """Return tensor of combinations of k elements.
 
     Parameters
     ----------
-    arr : 1D array or tensor
+    arr : 1D array or tensor. The length can be unknown until run time.
     k : number of elements to make combinations of .
 
     Returns
@@ -138,18 +218,22 @@ def combinations(arr, k):
     a 2D tensor of combinations. Each row is a combination, and each element of
     the combination is in the columns.
 
+    The combinations are gathered from arr with one index matrix. It is a
+    constant when the length of arr is known, and otherwise it is computed in
+    the graph.
 
     Related: pydoc:itertools.combinations
 
     """
     tensor = tf.convert_to_tensor(arr)
 
-    shape = tensor.get_shape().as_list()
-    if len(shape) != 1:
+    shape = tensor.get_shape()
+    if shape.ndims is not None and shape.ndims != 1:
         raise ValueError("Tensor must be 1d")
 
-    N = shape[0]
-    inds = np.arange(N)
-    combination_indices = [combination for combination
-                           in itertools.combinations(inds, k)]
-    return tf.stack([tf.gather(arr, ind) for ind in combination_indices])
+    N = shape.as_list()[0] if shape.ndims is not None else None
+    if N is not None:
+        indices = tf.constant(_combination_indices(N, k))
+    else:
+        indices = _combination_indices_tf(tf.size(tensor), k)
+    return tf.gather(tensor, indices)